@@ -0,0 +1,244 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import itertools
+import numpy as np
+import taichi as ti
+
+SIZES = [128, 256, 512, 1024, 2048]
+
+# the same scene for every run: a dye plume pushed upwards from the bottom
+VISCOSITY = 0.0001
+DIFFUSION_RATE = 0.00001
+TIME_STEP = 0.1
+SOURCE_DENSITY = 1
+SOURCE_FORCE = 0.1
+
+
+def summarize(samples) -> dict:
+  samples = np.array(samples)
+  return {
+    "mean": float(samples.mean()),
+    "p50": float(np.percentile(samples, 50)),
+    "p99": float(np.percentile(samples, 99)),
+  }
+
+
+def benchmark(n: int, pressure_solver: str, diffusion_solver: str, velocity_layout: str, precision: str, steps: int, warmup: int) -> dict:
+  from solver.fluid_field import FluidField
+  from solver.profiling import StageProfiler
+
+  fluid = FluidField(n, pressure_solver, diffusion_solver, velocity_layout, precision)
+  fluid.viscosity = VISCOSITY
+  fluid.diffusion_rate = DIFFUSION_RATE
+
+  x = n // 2
+  y = n // 10
+  radius = max(1, n // 50)
+
+  def step():
+    fluid.add_density(x, y, radius, SOURCE_DENSITY)
+    fluid.add_force(x, y, radius, 0, SOURCE_FORCE)
+    fluid.step(TIME_STEP)
+    fluid.reset_fields()
+
+  # the first steps pay for compiling every kernel
+  for _ in range(warmup):
+    step()
+  ti.sync()
+
+  step_times = []
+  for _ in range(steps):
+    start = time.perf_counter()
+    step()
+    ti.sync()
+    step_times.append(time.perf_counter() - start)
+
+  # stage timings run separately as the syncs between stages slow the step down
+  fluid.profiler = StageProfiler(window=steps)
+  for _ in range(steps):
+    step()
+  statistics = fluid.profiler.statistics()
+  statistics.pop("step")
+
+  return {
+    "n": n,
+    "pressure_solver": pressure_solver,
+    "diffusion_solver": diffusion_solver,
+    "velocity_layout": velocity_layout,
+    "precision": precision,
+    "memory_bytes": int(fluid.memory_bytes()),
+    "launches": fluid.launches,
+    "step": summarize(step_times),
+    "cells_per_second": n * n / float(np.percentile(step_times, 50)),
+    "stages": { name: { key: stage[key] for key in ("mean", "p50", "p99", "iterations_mean") if key in stage } for name, stage in statistics.items() },
+  }
+
+
+def run(args):
+  ti.init(arch=getattr(ti, args.arch), random_seed=0)
+
+  results = {}
+  for n, pressure_solver, diffusion_solver, velocity_layout, precision in itertools.product(args.sizes, args.pressure_solvers, args.diffusion_solvers, args.velocity_layouts, args.precisions):
+    key = f"{pressure_solver}/{diffusion_solver}/{velocity_layout}/{precision}/{n}"
+    results[key] = benchmark(n, pressure_solver, diffusion_solver, velocity_layout, precision, args.steps, args.warmup)
+    print(f"{key}: {results[key]['step']['p50'] * 1000:.2f} ms/step, {results[key]['memory_bytes'] / 2**20:.1f} MiB", file=sys.stderr)
+
+  report = {
+    "meta": {
+      "arch": args.arch,
+      "taichi": ".".join(str(part) for part in ti.__version__),
+      "python": platform.python_version(),
+      "machine": platform.machine(),
+      "processor": platform.processor(),
+      "steps": args.steps,
+      "warmup": args.warmup,
+    },
+    "results": results,
+  }
+
+  if args.output:
+    with open(args.output, "w") as file:
+      json.dump(report, file, indent=2)
+  else:
+    print(json.dumps(report, indent=2))
+
+
+def benchmark_distributed(n: int, workers: int, arch: str, steps: int, warmup: int) -> float:
+  # median seconds per step of the scene split over `workers` processes
+  from solver.distributed import DistributedFluidField
+
+  with DistributedFluidField(n, workers, arch=arch) as fluid:
+    fluid.viscosity = VISCOSITY
+    fluid.diffusion_rate = DIFFUSION_RATE
+
+    x = n // 2
+    y = n // 10
+    radius = max(1, n // 50)
+
+    step_times = []
+    for index in range(warmup + steps):
+      start = time.perf_counter()
+      fluid.add_density(x, y, radius, SOURCE_DENSITY)
+      fluid.add_force(x, y, radius, 0, SOURCE_FORCE)
+      fluid.step(TIME_STEP)
+      fluid.reset_fields()
+      if index >= warmup:
+        step_times.append(time.perf_counter() - start)
+
+  return float(np.percentile(step_times, 50))
+
+
+def scaling(args):
+  # Strong scaling splits one grid of `size` over more workers, weak
+  # scaling grows the grid with the workers so each slab keeps the
+  # cells of a `size` grid. Efficiency is relative to the fewest workers.
+  results = {}
+  for mode in args.modes:
+    for workers in args.workers:
+      n = args.size
+      if mode == "weak":
+        n = int(round(args.size * workers ** 0.5 / workers)) * workers
+      step_time = benchmark_distributed(n, workers, args.arch, args.steps, args.warmup)
+      results[f"{mode}/{workers}"] = { "n": n, "workers": workers, "step_p50": step_time, "cells_per_second": n * n / step_time }
+
+    base = results[f"{mode}/{args.workers[0]}"]
+    for workers in args.workers:
+      result = results[f"{mode}/{workers}"]
+      if mode == "strong":
+        result["efficiency"] = base["step_p50"] * base["workers"] / (result["step_p50"] * workers)
+      else:
+        result["efficiency"] = base["step_p50"] / result["step_p50"]
+      print(f"{mode} n={result['n']} workers={workers}: {result['step_p50'] * 1000:.2f} ms/step, efficiency {result['efficiency']:.0%}", file=sys.stderr)
+
+  report = {
+    "meta": {
+      "arch": args.arch,
+      "cpu_count": os.cpu_count(),
+      "steps": args.steps,
+      "warmup": args.warmup,
+    },
+    "results": results,
+  }
+  if args.output:
+    with open(args.output, "w") as file:
+      json.dump(report, file, indent=2)
+  else:
+    print(json.dumps(report, indent=2))
+
+
+def compare(args) -> int:
+  with open(args.baseline) as file:
+    baseline = json.load(file)["results"]
+  with open(args.current) as file:
+    current = json.load(file)["results"]
+
+  regressions = 0
+  for key in sorted(baseline.keys() & current.keys()):
+    metrics = [("step", baseline[key]["step"][args.metric], current[key]["step"][args.metric])]
+    for stage in sorted(baseline[key]["stages"].keys() & current[key]["stages"].keys()):
+      metrics.append((stage, baseline[key]["stages"][stage][args.metric], current[key]["stages"][stage][args.metric]))
+
+    for name, before, after in metrics:
+      # stages that take a few microseconds only measure timer noise
+      if before < args.min_time:
+        continue
+
+      change = after / before - 1
+      flag = "REGRESSION" if change > args.threshold else ""
+      regressions += flag != ""
+      print(f"{key:<40} {name:<22} {before * 1000:10.3f} ms {after * 1000:10.3f} ms {change:+8.1%} {flag}")
+
+  for key in sorted(baseline.keys() - current.keys()):
+    print(f"{key:<40} missing from {args.current}")
+
+  print(f"{regressions} regression(s) above {args.threshold:.0%}")
+  return 1 if regressions else 0
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Benchmark FluidField across grid sizes and solvers")
+  commands = parser.add_subparsers(dest="command", required=True)
+
+  run_parser = commands.add_parser("run", help="time the solver and write the results as json")
+  run_parser.add_argument("--arch", default="cpu", choices=["cpu", "gpu", "cuda", "vulkan", "metal"])
+  run_parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+  run_parser.add_argument("--pressure-solvers", nargs="+", default=["jacobi"], choices=["jacobi", "multigrid", "spectral"])
+  run_parser.add_argument("--diffusion-solvers", nargs="+", default=["relaxation"], choices=["relaxation", "conjugate_gradient"])
+  run_parser.add_argument("--velocity-layouts", nargs="+", default=["split"], choices=["split", "aos", "soa"])
+  run_parser.add_argument("--precisions", nargs="+", default=["f32"], choices=["f16", "f32", "f64"])
+  run_parser.add_argument("--steps", type=int, default=20)
+  run_parser.add_argument("--warmup", type=int, default=3)
+  run_parser.add_argument("--output", help="json file for the results, printed when omitted")
+
+  scaling_parser = commands.add_parser("scaling", help="time DistributedFluidField over a growing number of worker processes")
+  scaling_parser.add_argument("--arch", default="cpu", choices=["cpu", "gpu", "cuda", "vulkan", "metal"])
+  scaling_parser.add_argument("--size", type=int, default=1024, help="grid size, per worker share of it for weak scaling")
+  scaling_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+  scaling_parser.add_argument("--modes", nargs="+", default=["strong", "weak"], choices=["strong", "weak"])
+  scaling_parser.add_argument("--steps", type=int, default=20)
+  scaling_parser.add_argument("--warmup", type=int, default=3)
+  scaling_parser.add_argument("--output", help="json file for the results, printed when omitted")
+
+  compare_parser = commands.add_parser("compare", help="flag regressions of a run against a stored baseline")
+  compare_parser.add_argument("baseline")
+  compare_parser.add_argument("current")
+  compare_parser.add_argument("--metric", default="p50", choices=["mean", "p50", "p99"])
+  compare_parser.add_argument("--threshold", type=float, default=0.1, help="relative slowdown counted as a regression")
+  compare_parser.add_argument("--min-time", type=float, default=1e-4, help="skip timings below this many seconds")
+
+  args = parser.parse_args(argv)
+  if args.command == "run":
+    run(args)
+    return 0
+  if args.command == "scaling":
+    scaling(args)
+    return 0
+  return compare(args)
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
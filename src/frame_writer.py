@@ -0,0 +1,68 @@
+import os
+import queue
+import threading
+import imageio.v3 as imageio
+from numpy import ndarray
+
+VIDEO_EXTENSIONS = (".gif", ".mp4", ".webm", ".avi", ".mkv", ".mov")
+
+
+class FrameWriter:
+  # Encodes frames on a background thread. `write` only blocks while 
+  # `queue_size` frames are already waiting, so the simulation keeps 
+  # stepping while earlier frames are encoded. A path with a video 
+  # extension is written as one video, anything else is treated as a 
+  # directory of numbered PNGs.
+  def __init__(self, path: str, queue_size: int = 8):
+    self.path = path
+    self.is_video = path.lower().endswith(VIDEO_EXTENSIONS)
+    self.frames_written = 0
+    self.error = None
+
+    if not self.is_video:
+      os.makedirs(path, exist_ok=True)
+
+    self.queue = queue.Queue(maxsize=queue_size)
+    self.thread = threading.Thread(target=self.__run, daemon=True)
+    self.thread.start()
+
+  def write(self, frame: ndarray):
+    if self.error is not None:
+      raise self.error
+    self.queue.put(frame)
+
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
+    if self.error is not None:
+      raise self.error
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    self.close()
+
+  def __run(self):
+    video = None
+    try:
+      if self.is_video:
+        video = imageio.imopen(self.path, "w")
+      while True:
+        frame = self.queue.get()
+        if frame is None:
+          break
+
+        if video is not None:
+          video.write(frame)
+        else:
+          imageio.imwrite(os.path.join(self.path, f"frame_{self.frames_written:05d}.png"), frame)
+        self.frames_written += 1
+    except Exception as error:
+      self.error = error
+      # keep draining so `write` and `close` never block on a dead writer
+      while self.queue.get() is not None:
+        pass
+    finally:
+      if video is not None:
+        video.close()
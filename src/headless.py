@@ -0,0 +1,163 @@
+import sys
+import json
+import time
+import argparse
+import taichi as ti
+
+DEFAULT_CONFIG = {
+  "arch": "gpu",
+  "n": 256,
+  "steps": 300,
+  "time_step": 0.1,
+  # a CFL number splits every time step into stable substeps, see `FluidField.advance`
+  "cfl": None,
+  "viscosity": 0,
+  "diffusion_rate": 0,
+  "pressure_solver": "jacobi",
+  "diffusion_solver": "relaxation",
+  "velocity_layout": "split",
+  # storage type of the solver fields, "f16", "f32" or "f64", None for the ti.init default
+  "precision": None,
+  # only step the tiles that hold fluid, see `ActiveTiles`
+  "active_tiles": False,
+  # gather the sources of a step and add them to the cells under them, see `SplatQueue`
+  "source_queue": False,
+  # compiled kernels are kept in taichi's offline cache, None keeps its default
+  # directory, `warmup.py build` fills it ahead of a batch of runs
+  "cache_directory": None,
+  # a frame is exported every `export_every` steps, no output runs the solver only
+  "output": None,
+  "export_every": 1,
+  "queue_size": 8,
+  # checkpoints are written asynchronously every `checkpoint_every` steps,
+  # `restore` continues from a checkpoint file instead of an empty field
+  "checkpoint_directory": None,
+  "checkpoint_every": 100,
+  "restore": None,
+  # sources are placed in [0, 1] window coordinates like the mouse in main.py,
+  # and inject every step from `start` until `stop` (exclusive, None runs forever)
+  "sources": [
+    { "x": 0.5, "y": 0.1, "radius": 10, "density": 1, "h_force": 0, "v_force": 0.1, "start": 0, "stop": 100 }
+  ]
+}
+
+
+def load_config(path: str = None, overrides: dict = None) -> dict:
+  config = dict(DEFAULT_CONFIG)
+  if path is not None:
+    with open(path) as file:
+      config.update(json.load(file))
+  if overrides:
+    config.update({ key: value for key, value in overrides.items() if value is not None })
+  return config
+
+
+def init_taichi(config: dict):
+  options = {}
+  if config["cache_directory"]:
+    options["offline_cache_file_path"] = config["cache_directory"]
+  ti.init(arch=getattr(ti, config["arch"]), **options)
+
+
+def create_fluid(config: dict):
+  # imported after ti.init so module level fields land on the chosen arch
+  from solver.fluid_field import FluidField
+  from solver.active_tiles import ActiveTiles
+  from solver.splat_queue import SplatQueue
+
+  n = config["n"]
+  fluid = FluidField(n, config["pressure_solver"], config["diffusion_solver"], config["velocity_layout"], config["precision"])
+  fluid.viscosity = config["viscosity"]
+  fluid.diffusion_rate = config["diffusion_rate"]
+  if config["active_tiles"]:
+    fluid.active_tiles = ActiveTiles(n)
+  if config["source_queue"]:
+    fluid.source_queue = SplatQueue()
+  fluid.cfl = config["cfl"]
+  return fluid
+
+
+def run(config: dict) -> dict:
+  from solver.checkpoint import AsyncCheckpointer
+  from frame_writer import FrameWriter
+
+  n = config["n"]
+  fluid = create_fluid(config)
+  if config["restore"]:
+    fluid.load_checkpoint(config["restore"])
+  if config["checkpoint_directory"]:
+    fluid.checkpointer = AsyncCheckpointer(config["checkpoint_directory"], config["checkpoint_every"])
+
+  frame = ti.field(dtype=ti.u8, shape=(n, n))
+
+  @ti.kernel
+  def render(density: ti.template()):
+    # rows top to bottom like an image, with the same clipping the window applies
+    for i, j in frame:
+      frame[n - 1 - j, i] = ti.cast(ti.min(ti.max(density[i, j], 0.0), 1.0) * 255, ti.u8)
+
+  def add_sources(step: int):
+    for source in config["sources"]:
+      stop = source.get("stop")
+      if step < source.get("start", 0) or (stop is not None and step >= stop):
+        continue
+
+      x = int(source["x"] * n)
+      y = int(source["y"] * n)
+      radius = source.get("radius", 10)
+      if source.get("density", 0) != 0:
+        fluid.add_density(x, y, radius, source["density"])
+      if source.get("h_force", 0) != 0 or source.get("v_force", 0) != 0:
+        fluid.add_force(x, y, radius, source.get("h_force", 0), source.get("v_force", 0))
+
+  writer = FrameWriter(config["output"], config["queue_size"]) if config["output"] else None
+  frames = 0
+  start = time.perf_counter()
+  try:
+    for _ in range(config["steps"]):
+      step = fluid.frame_index
+      add_sources(step)
+      fluid.advance(config["time_step"])
+      fluid.reset_fields()
+
+      if writer is not None and step % config["export_every"] == 0:
+        render(fluid.density.current)
+        writer.write(frame.to_numpy())
+        frames += 1
+    ti.sync()
+    simulated = time.perf_counter() - start
+  finally:
+    if writer is not None:
+      writer.close()
+    if fluid.checkpointer is not None:
+      fluid.checkpointer.wait()
+  elapsed = time.perf_counter() - start
+
+  return {
+    "steps": config["steps"],
+    "frames": frames,
+    "simulation_seconds": simulated,
+    "total_seconds": elapsed,
+    "steps_per_second": config["steps"] / simulated,
+  }
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Run the fluid solver without a window")
+  parser.add_argument("config", nargs="?", help="json file overriding the default config")
+  parser.add_argument("--arch", choices=["cpu", "gpu", "cuda", "vulkan", "metal"])
+  parser.add_argument("--n", type=int)
+  parser.add_argument("--steps", type=int)
+  parser.add_argument("--output", help="directory for a png sequence, or a video file such as out.gif / out.mp4")
+  parser.add_argument("--restore", help="checkpoint file to continue from")
+  args = parser.parse_args(argv)
+
+  config = load_config(args.config, { "arch": args.arch, "n": args.n, "steps": args.steps, "output": args.output, "restore": args.restore })
+  init_taichi(config)
+
+  stats = run(config)
+  print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
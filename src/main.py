@@ -1,7 +1,13 @@
 import taichi as ti
 import taichi.math as tim
 from solver.fluid_field import FluidField
-from image_loader import load_image, convert_to_greyscale
+from solver.obstacles import Obstacles
+from solver.resolution import ResolutionScaler
+from solver.splat_queue import SplatQueue
+from solver.tracers import Tracers
+from image_loader import load_image
+from source_images import SourceImageCache, VideoSource, prepare_mask
+from velocity_glyphs import VelocityGlyphs
 
 ti.init(arch=ti.gpu)
 
@@ -21,117 +27,169 @@ force = 0.1
 source = 1
 source_radius = 10
 
-fluid = FluidField(n)
-fluid.viscosity = viscosity
-fluid.diffusion_rate = diffusion_rate
+# opt-in modes, left off the field steps once per frame at the window's size
+# split frames into substeps backtracing at most this many cells
+cfl = None
+# queue sources and add them under the splats only, instead of through the source buffers
+use_splat_queue = False
+# seconds a frame of the solver may take, the grid shrinks below the window to keep to it
+frame_budget = None
+
+
+def create_fluid(size, builder=None):
+  fluid = FluidField(size, builder=builder)
+  fluid.viscosity = viscosity
+  fluid.diffusion_rate = diffusion_rate
+  fluid.cfl = cfl
+  if use_splat_queue:
+    fluid.source_queue = SplatQueue()
+  return fluid
+
+
+if frame_budget is None:
+  fluid = create_fluid(n)
+else:
+  # stands in for the current field, which is replaced whenever the grid is resized
+  fluid = ResolutionScaler(create_fluid, n, frame_budget, max_n=n)
 
 window = ti.ui.Window("2D Fluid", res=window_size, pos=(50, 50))
 canvas = window.get_canvas()
 
 velocity_vector_width = 0.002
 
-vertices = ti.Vector.field(3, dtype=ti.f32, shape=(n*n*2))
-colors = ti.Vector.field(3, dtype=ti.f32, shape=(n*n*2))
+# toggled with "v", the glyph buffers are only allocated the first time
+show_velocity = False
+velocity_glyphs = None
+
+# toggled with "t", particles emitted under the cursor per frame a stroke is drawn
+show_tracers = False
+tracers = None
+tracers_per_frame = 2000
 
 
 @ti.kernel
-def render():
+def render(fluid_n: int, density: ti.template()):
+  # a grid smaller than the window is stretched over it
+  scale = fluid_n / window_width
   for i, j in pixels:
-    cell_x = ti.round(i / cell_size, dtype=int)
-    cell_y = ti.round(j / cell_size, dtype=int)
-    pixels[i,j] = tim.min(100, fluid.density.current[cell_x,cell_y])
+    cell_x = ti.round(i * scale, dtype=int)
+    cell_y = ti.round(j * scale, dtype=int)
+    pixels[i,j] = tim.min(100, density[cell_x,cell_y])
 
 
-def on_click():
-  mouse_x, mouse_y = window.get_cursor_pos()
-  x = int(mouse_x * n)
-  y = int(mouse_y * n)
-  add_source(x, y, fluid.density.previous, source)
+# cell under the cursor in the previous frame a button was held, strokes start there
+last_cursor = None
 
 
-def on_right_click():
+def cursor_cell():
   mouse_x, mouse_y = window.get_cursor_pos()
-  x = int(mouse_x * n)
-  y = int(mouse_y * n)
-#   add_source(x, y, fluid.h_velocity.previous, -force)
-  add_source(x, y, fluid.v_velocity.previous, force)
+  return int(mouse_x * fluid.n), int(mouse_y * fluid.n)
 
 
-@ti.kernel
-def add_source(x: int, y: int, field: ti.template(), value: float):
-  for i, j in ti.ndrange((-source_radius, source_radius+1), (-source_radius, source_radius+1)):
-    if x + i < 0 or \
-      x + i >= n or \
-      y + j < 0 or \
-      y + j >= n:
-      continue
-    # add in radius around mouse with range as radius
-    if i*i + j*j <= source_radius*source_radius:
-      field[x+i, y+j] += value
+def cell_radius():
+  return max(1, round(source_radius * fluid.n / n))
 
 
-@ti.kernel
-def render_velocity():
-  for i, j in ti.ndrange(n, n):
-    cell_idx = i * n + j
+def on_click(x, y):
+  x0, y0 = last_cursor or (x, y)
+  fluid.add_stroke(x0, y0, x, y, cell_radius(), amount=source)
+  if show_tracers:
+    tracers.emit(x, y, cell_radius(), tracers_per_frame)
 
-    x = i * cell_size
-    y = j * cell_size
 
-    n_x = x / window_width
-    n_y = y / window_height
+def on_right_click(x, y):
+  x0, y0 = last_cursor or (x, y)
+#   fluid.add_stroke(x0, y0, x, y, cell_radius(), h_force=-force, v_force=force)
+  fluid.add_stroke(x0, y0, x, y, cell_radius(), v_force=force)
 
-    vh = fluid.h_velocity.current[i, j]
-    vv = fluid.v_velocity.current[i, j]
-    velocity = ti.Vector([vh, vv, 0])
 
-    line_start = ti.Vector([n_x, n_y, 0])
-    line_end = line_start + velocity.normalized() * 0.02
+def toggle_velocity():
+  global show_velocity, velocity_glyphs
+  show_velocity = not show_velocity
+  if show_velocity and velocity_glyphs is None:
+    velocity_glyphs = VelocityGlyphs(fluid.n, adaptive=True)
 
-    vertices[cell_idx * 2] = line_start
-    vertices[cell_idx * 2 + 1] = line_end
 
-    vel2d = ti.Vector([vh, vv])
-    vel_length = vel2d.norm() * 100
-    colors[cell_idx * 2] = (vel_length, 0, 1 - vel_length)
-    colors[cell_idx * 2 + 1] = (vel_length, 0, 1 - vel_length)
+def toggle_tracers():
+  global show_tracers, tracers
+  show_tracers = not show_tracers
+  if show_tracers and tracers is None:
+    tracers = Tracers(fluid.n)
+
 
-  
 def process_events(window: ti.ui.Window):
+  if window.get_event(ti.ui.PRESS):
+    if window.event.key == "v":
+      toggle_velocity()
+    if window.event.key == "t":
+      toggle_tracers()
+
+  global last_cursor
+  if not (window.is_pressed(ti.ui.LMB) or window.is_pressed(ti.ui.RMB)):
+    last_cursor = None
+    return
+
+  x, y = cursor_cell()
   if window.is_pressed(ti.ui.LMB):
-    on_click()
+    on_click(x, y)
   
   if window.is_pressed(ti.ui.RMB):
-    on_right_click()
+    on_right_click(x, y)
+  last_cursor = (x, y)
 
 
-@ti.kernel
-def blit_image(image: ti.types.ndarray(dtype=ti.i8, ndim=2), field: ti.template()):
-  for i, j in ti.ndrange(n, n):
-    normalized_pixel = ti.cast(image[i,j] / 128, ti.f32)
-    a = tim.max(0, abs(normalized_pixel) * 2.0 )
-    shaped_pixel = tim.pow(a, 2.5) + 1
-    field[j,n-i] = shaped_pixel
+# decoded, resized and shaped images stay on the device between paints
+source_images = SourceImageCache(fluid.n)
+
+# a `VideoSource` paints its next frame every step
+video = None
+
+
+def source_field():
+  # queued sources never read the source buffer, paint straight into the density then
+  return fluid.density.previous if fluid.source_queue is None else fluid.density.current
 
 
 def paint_image(path: str):
-  image = load_image(path)
-  greyscale_image = convert_to_greyscale(image)
-  blit_image(greyscale_image, fluid.density.previous)
+  source_images.paint(path, source_field())
+
+
+def load_obstacles(path: str):
+  # the dark parts of the image turn solid
+  obstacles = Obstacles(fluid.n)
+  obstacles.set_mask(prepare_mask(load_image(path), fluid.n))
+  fluid.obstacles = obstacles
 
 
 # paint_image("src/assets/test-2.jpg")
+# load_obstacles("src/assets/test-2.jpg")
+# video = VideoSource("src/assets/test.gif", fluid.n)
 
 while window.running:
   process_events(window)
-
-  fluid.step(time_step)
-
-  render()
+  if video is not None:
+    video.paint(source_field())
+
+  if fluid.advance(time_step):
+    # only a `ResolutionScaler` resizes, everything sized to the old grid follows it
+    last_cursor = None
+    source_images = SourceImageCache(fluid.n)
+    if video is not None:
+      video.resize(fluid.n)
+    if velocity_glyphs is not None:
+      velocity_glyphs = VelocityGlyphs(fluid.n, adaptive=True)
+    if tracers is not None:
+      tracers.resize(fluid.n)
+
+  render(fluid.n, fluid.density.current)
+  if show_tracers:
+    tracers.advect(time_step, fluid)
+    tracers.rasterize(pixels)
   canvas.set_image(pixels)
   
-#   render_velocity()
-#   canvas.lines(vertices=vertices, per_vertex_color=colors, width=velocity_vector_width)
+  if show_velocity:
+    velocity_glyphs.update(fluid)
+    velocity_glyphs.draw(canvas, velocity_vector_width)
   window.show()
 
   fluid.reset_fields()
@@ -0,0 +1,145 @@
+import taichi as ti
+from .field_helpers import is_vector, new_field, cell_count, cell_index
+from .launch_counter import kernel
+
+# largest tile edge picked when none is given
+MAX_TILE_SIZE = 16
+
+
+@ti.data_oriented
+class ActiveTiles:
+  # Splits the interior into square tiles and keeps a list of the ones
+  # that hold fluid. Kernels handed these tiles only visit the listed
+  # cells, so a step costs in proportion to the active area. A tile is
+  # live while any watched value in it is above `threshold`, tiles within
+  # `halo` tiles of a live one stay active so fluid can flow into them.
+  # Tiles that drop out are zeroed, cells outside the list are treated
+  # as quiescent by every tile aware kernel.
+  #
+  # Only tiles already in the list are scanned, values written elsewhere
+  # (sources) must `activate` their area or set `rescan` for a full scan.
+  def __init__(self, n, tile_size=None, threshold=1e-4, halo=1, builder=None):
+    if tile_size is None:
+      tile_size = max(size for size in range(1, MAX_TILE_SIZE + 1) if n % size == 0)
+    if n % tile_size != 0:
+      raise ValueError(f"Tile size {tile_size} does not divide n={n}")
+
+    self.n = n
+    self.size = tile_size
+    self.cells = tile_size * tile_size
+    self.threshold = threshold
+    self.halo = halo
+
+    # scan every cell on the next update, the first one always does
+    self.rescan = True
+
+    tiles = n // tile_size
+    self.tiles = tiles
+    self.live = new_field(ti.i32, (tiles, tiles), builder=builder)
+    self.active = new_field(ti.i32, (tiles, tiles), builder=builder)
+    self.tile_list = new_field(ti.i32, tiles * tiles, 2, builder=builder)
+    self.count = new_field(ti.i32, (), builder=builder)
+
+  def activate(self, x: int, y: int, radius: int):
+    # mark the tiles under a splat at field index (x, y), interior 
+    # cell i lies in tile (i - 1) // size
+    last = self.tiles - 1
+    i0 = min(max((x - radius - 1) // self.size, 0), last)
+    i1 = min(max((x + radius - 1) // self.size, 0), last)
+    j0 = min(max((y - radius - 1) // self.size, 0), last)
+    j1 = min(max((y + radius - 1) // self.size, 0), last)
+    _mark_live(i0, i1 + 1, j0, j1 + 1, self.live)
+
+  def update(self, fields, scratch=()):
+    # `fields` decide which tiles are live, `scratch` fields are only zeroed with them
+    if self.rescan:
+      _scan_all(self.n, self.size, self.threshold, tuple(fields), self.live)
+      self.rescan = False
+    else:
+      _scan_active(self.n, self.threshold, self, tuple(fields), self.live)
+    _activate(self.size, self.halo, tuple(fields) + tuple(scratch), self.live, self.active)
+    _build_list(self.tiles, self.live, self.active, self.tile_list, self.count)
+
+  def exchange(self, *fields):
+    # one process holds every tile, there are no halos to refresh
+    pass
+
+  def reduce_sum(self, value: float) -> float:
+    return value
+
+  def fraction(self) -> float:
+    return self.count[None] / (self.tiles * self.tiles)
+
+
+@ti.func
+def _magnitude(value, vector: ti.template()):
+  result = 0.0
+  if ti.static(vector):
+    result = ti.abs(value).max()
+  else:
+    result = ti.abs(value)
+  return result
+
+
+@ti.func
+def _above(fields: ti.template(), i, j, threshold):
+  above = False
+  for field in ti.static(fields):
+    if _magnitude(field[i, j], ti.static(is_vector(field))) > threshold:
+      above = True
+  return above
+
+
+@kernel
+def _mark_live(i0: int, i1: int, j0: int, j1: int, live: ti.template()):
+  for tile_i, tile_j in ti.ndrange((i0, i1), (j0, j1)):
+    live[tile_i, tile_j] = 1
+
+
+@kernel
+def _scan_all(n: int, size: int, threshold: float, fields: ti.template(), live: ti.template()):
+  for i, j in ti.ndrange((1, n + 1), (1, n + 1)):
+    if _above(fields, i, j, threshold):
+      live[(i - 1) // size, (j - 1) // size] = 1
+
+
+@kernel
+def _scan_active(n: int, threshold: float, tiles: ti.template(), fields: ti.template(), live: ti.template()):
+  for c in range(cell_count(n, tiles)):
+    i, j = cell_index(n, tiles, c)
+    if _above(fields, i, j, threshold):
+      live[(i - 1) // tiles.size, (j - 1) // tiles.size] = 1
+
+
+@kernel
+def _activate(size: int, halo: int, fields: ti.template(), live: ti.template(), active: ti.template()):
+  for tile_i, tile_j in active:
+    active_next = 0
+    for di, dj in ti.ndrange((-halo, halo + 1), (-halo, halo + 1)):
+      ni = tile_i + di
+      nj = tile_j + dj
+      if 0 <= ni < active.shape[0] and 0 <= nj < active.shape[1]:
+        active_next |= live[ni, nj]
+
+    if active[tile_i, tile_j] == 1 and active_next == 0:
+      # below the threshold, zero what is left so a later activation starts clean
+      for k in range(size * size):
+        i = 1 + tile_i * size + k // size
+        j = 1 + tile_j * size + k % size
+        for field in ti.static(fields):
+          field[i, j] = 0
+    active[tile_i, tile_j] = active_next
+
+
+@kernel
+def _build_list(tiles: int, live: ti.template(), active: ti.template(), tile_list: ti.template(), count: ti.template()):
+  # serial, so the list and every sweep over it run in a fixed order
+  count[None] = 0
+  ti.loop_config(serialize=True)
+  for t in range(tiles * tiles):
+    tile_i = t // tiles
+    tile_j = t % tiles
+    if active[tile_i, tile_j] == 1:
+      tile_list[count[None]] = ti.Vector([tile_i, tile_j])
+      count[None] += 1
+    live[tile_i, tile_j] = 0
@@ -1,31 +1,73 @@
 import taichi as ti
 import taichi.math as tim
-from .field_helpers import contain, bilinear_interpolate_nearest, nullify_boundary_flow
+from .field_helpers import bilinear_interpolate_nearest, cell_count, cell_index, exchange, enforce, set_boundary, index, CONTAIN_WALLS, H_VELOCITY_WALLS, V_VELOCITY_WALLS, VELOCITY_WALLS
+from .launch_counter import kernel
 
-def advect_density(n, dt, density, h_velocity, v_velocity):
-  advect_kernel(n, dt, density, h_velocity, v_velocity)
-  contain(n, density.current)
+def advect_density(n, dt, density, h_velocity, v_velocity, tiles=None, obstacles=None):
+  advect_kernel(n, dt, density.current, density.previous, h_velocity.current, v_velocity.current, CONTAIN_WALLS, tiles)
+  exchange(tiles, density.current)
+  enforce(obstacles, CONTAIN_WALLS, density.current)
 
 
-def advect_velocity(n, dt, h_velocity, v_velocity, h_velocity_prev, v_velocity_prev):
-  advect_kernel(n, dt, h_velocity, h_velocity_prev, v_velocity_prev)
-  advect_kernel(n, dt, v_velocity, h_velocity_prev, v_velocity_prev)
-  nullify_boundary_flow(n, h_velocity.current, v_velocity.current)
+def advect_velocity(n, dt, h_velocity, v_velocity, h_velocity_prev, v_velocity_prev, tiles=None, obstacles=None):
+  advect_kernel(n, dt, h_velocity.current, h_velocity.previous, h_velocity_prev.current, v_velocity_prev.current, H_VELOCITY_WALLS, tiles)
+  advect_kernel(n, dt, v_velocity.current, v_velocity.previous, h_velocity_prev.current, v_velocity_prev.current, V_VELOCITY_WALLS, tiles)
+  exchange(tiles, h_velocity.current, v_velocity.current)
+  enforce(obstacles, H_VELOCITY_WALLS, h_velocity.current)
+  enforce(obstacles, V_VELOCITY_WALLS, v_velocity.current)
 
 
-@ti.kernel
-def advect_kernel(n: int, dt: float, tv_field: ti.template(), tv_h_velocity: ti.template(), tv_v_velocity: ti.template()):
+def advect_density_vector(n, dt, density, velocity, tiles=None, obstacles=None):
+  advect_by_vector_kernel(n, dt, density.current, density.previous, velocity.current, CONTAIN_WALLS, tiles)
+  exchange(tiles, density.current)
+  enforce(obstacles, CONTAIN_WALLS, density.current)
+
+
+def advect_velocity_vector(n, dt, velocity, tiles=None, obstacles=None):
+  # one backtrace per cell moves both components, tracing through the
+  # projected velocity that is being advected
+  advect_by_vector_kernel(n, dt, velocity.current, velocity.previous, velocity.previous, VELOCITY_WALLS, tiles)
+  exchange(tiles, velocity.current)
+  enforce(obstacles, VELOCITY_WALLS, velocity.current)
+
+
+@kernel
+def advect_kernel(n: int, dt: float, current: ti.template(), previous: ti.template(), h_velocity: ti.template(), v_velocity: ti.template(), walls: ti.template(), tiles: ti.template()):
+  n_scale = dt * n
+  for c in range(cell_count(n, tiles)):
+    i, j = cell_index(n, tiles, c)
+    advect_cell(n, n_scale, current, previous, h_velocity, v_velocity, i, j, walls)
+
+
+@ti.func
+def advect_cell(n, n_scale, current, previous, h_velocity, v_velocity, i, j, walls: ti.template(), member: ti.template() = None):
+  # P is the particle at (i, j)
+  # Move P back in time by dt 
+  # to get the position of the particle at the start of the time step
+  x = i - n_scale * h_velocity[index(i, j, member)]
+  y = j - n_scale * v_velocity[index(i, j, member)]
+
+  # Clamp P_start to the grid 
+  # with a 0.5 unit border
+  x = tim.max(0.5, tim.min(n + 0.5, x))
+  y = tim.max(0.5, tim.min(n + 0.5, y))
+
+  value = bilinear_interpolate_nearest(x, y, previous, member)
+  current[index(i, j, member)] = value
+  set_boundary(n, current, i, j, value, walls, member)
+
+
+@kernel
+def advect_by_vector_kernel(n: int, dt: float, current: ti.template(), previous: ti.template(), velocity: ti.template(), walls: ti.template(), tiles: ti.template()):
   n_scale = dt * n
-  for i, j in ti.ndrange((1, n + 1), (1, n + 1)):
-    # P is the particle at (i, j)
-    # Move P back in time by dt 
-    # to get the position of the particle at the start of the time step
-    x = i - n_scale * tv_h_velocity.current[i, j]
-    y = j - n_scale * tv_v_velocity.current[i, j]
-
-    # Clamp P_start to the grid 
-    # with a 0.5 unit border
-    x = tim.max(0.5, tim.min(n + 0.5, x))
-    y = tim.max(0.5, tim.min(n + 0.5, y))
-
-    tv_field.current[i, j] = bilinear_interpolate_nearest(x, y, tv_field.previous)
+  for c in range(cell_count(n, tiles)):
+    i, j = cell_index(n, tiles, c)
+    position = ti.Vector([i, j], dt=float) - n_scale * velocity[i, j]
+
+    x = tim.max(0.5, tim.min(n + 0.5, position[0]))
+    y = tim.max(0.5, tim.min(n + 0.5, position[1]))
+
+    value = bilinear_interpolate_nearest(x, y, previous)
+    current[i, j] = value
+    set_boundary(n, current, i, j, value, walls)
+
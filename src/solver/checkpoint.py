@@ -0,0 +1,165 @@
+import os
+import json
+import struct
+import threading
+import numpy as np
+from taichi.lang.util import to_numpy_type
+
+# File layout: MAGIC, a little endian u32 version and u64 header length,
+# the json header, then every field as raw C ordered data starting at the
+# 64 byte aligned offset the header lists for it. Fields can therefore be
+# memory mapped straight out of the file without parsing or copying.
+MAGIC = b"FLUIDCKP"
+VERSION = 1
+ALIGNMENT = 64
+PREAMBLE = struct.Struct("<8sIQ")
+
+PARAMETERS = ("n", "viscosity", "diffusion_rate", "time_step", "step_index", "frame_index")
+
+
+def checkpoint_fields(fluid) -> dict:
+  fields = {
+    "density.current": fluid.density.current,
+    "density.previous": fluid.density.previous,
+  }
+  if fluid.velocity is None:
+    fields.update({
+      "h_velocity.current": fluid.h_velocity.current,
+      "h_velocity.previous": fluid.h_velocity.previous,
+      "v_velocity.current": fluid.v_velocity.current,
+      "v_velocity.previous": fluid.v_velocity.previous,
+    })
+  else:
+    fields.update({
+      "velocity.current": fluid.velocity.current,
+      "velocity.previous": fluid.velocity.previous,
+    })
+  fields.update({
+    "pressure": fluid.pressure,
+    "divergence": fluid.divergence,
+  })
+  return fields
+
+
+def snapshot(fluid) -> tuple:
+  # copy the solver state to host memory, the only part of a save that has to wait for the device
+  parameters = { name: getattr(fluid, name) for name in PARAMETERS }
+  arrays = { name: field.to_numpy() for name, field in checkpoint_fields(fluid).items() }
+  return parameters, arrays
+
+
+def write_checkpoint(path: str, parameters: dict, arrays: dict):
+  entries = []
+  offset = 0
+  for name, array in arrays.items():
+    entries.append({ "name": name, "dtype": array.dtype.str, "shape": list(array.shape), "offset": offset })
+    offset = __align(offset + array.nbytes)
+
+  header = json.dumps({ "parameters": parameters, "fields": entries }).encode()
+  data_start = __align(PREAMBLE.size + len(header))
+
+  # write next to the target and rename, so a crash never leaves half a checkpoint
+  temporary_path = path + ".tmp"
+  with open(temporary_path, "wb") as file:
+    file.write(PREAMBLE.pack(MAGIC, VERSION, len(header)))
+    file.write(header)
+    for entry, array in zip(entries, arrays.values()):
+      file.seek(data_start + entry["offset"])
+      file.write(np.ascontiguousarray(array).tobytes())
+    file.truncate(data_start + offset)
+  os.replace(temporary_path, path)
+
+
+def read_checkpoint(path: str) -> tuple:
+  # returns the parameters and read only memory maps of every field
+  with open(path, "rb") as file:
+    magic, version, header_length = PREAMBLE.unpack(file.read(PREAMBLE.size))
+    if magic != MAGIC:
+      raise ValueError(f"{path} is not a fluid checkpoint")
+    if version != VERSION:
+      raise ValueError(f"{path} has checkpoint version {version}, expected {VERSION}")
+    header = json.loads(file.read(header_length))
+
+  data_start = __align(PREAMBLE.size + header_length)
+  arrays = {
+    entry["name"]: np.memmap(path, dtype=np.dtype(entry["dtype"]), mode="r", offset=data_start + entry["offset"], shape=tuple(entry["shape"]))
+    for entry in header["fields"]
+  }
+  return header["parameters"], arrays
+
+
+def save_checkpoint(fluid, path: str):
+  write_checkpoint(path, *snapshot(fluid))
+
+
+def load_checkpoint(fluid, path: str):
+  parameters, arrays = read_checkpoint(path)
+  if parameters["n"] != fluid.n:
+    raise ValueError(f"Checkpoint {path} is for n={parameters['n']}, the field has n={fluid.n}")
+
+  missing = checkpoint_fields(fluid).keys() - arrays.keys()
+  if missing:
+    raise ValueError(f"Checkpoint {path} is missing {', '.join(sorted(missing))}, was it saved with another velocity layout?")
+  restore(fluid, parameters, arrays)
+
+
+def restore(fluid, parameters: dict, arrays: dict):
+  # the inverse of `snapshot`
+  for name, field in checkpoint_fields(fluid).items():
+    # a checkpoint loads into a field of any precision
+    field.from_numpy(np.asarray(arrays[name], dtype=to_numpy_type(field.dtype)))
+  # checkpoints written before frames could take substeps lack a frame index
+  parameters = dict({ "frame_index": parameters["step_index"] }, **parameters)
+  for name in PARAMETERS:
+    setattr(fluid, name, parameters[name])
+
+
+class AsyncCheckpointer:
+  # Saves a checkpoint every `every` steps. The step loop only waits for
+  # the copy to host memory, the file is written on a background thread.
+  # While a write is still running further checkpoints are skipped rather
+  # than stalling the loop, `skipped` counts them. Only the newest `keep`
+  # files are kept.
+  def __init__(self, directory: str, every: int = 100, keep: int = 2):
+    self.directory = directory
+    self.every = every
+    self.keep = keep
+    self.written = []
+    self.skipped = 0
+    self.error = None
+    self.thread = None
+
+    os.makedirs(directory, exist_ok=True)
+
+  def after_step(self, fluid):
+    if fluid.step_index % self.every != 0:
+      return
+    if self.error is not None:
+      raise self.error
+    if self.thread is not None and self.thread.is_alive():
+      self.skipped += 1
+      return
+
+    path = os.path.join(self.directory, f"checkpoint_{fluid.step_index:08d}.fluid")
+    parameters, arrays = snapshot(fluid)
+    self.thread = threading.Thread(target=self.__write, args=(path, parameters, arrays), daemon=True)
+    self.thread.start()
+
+  def wait(self):
+    if self.thread is not None:
+      self.thread.join()
+    if self.error is not None:
+      raise self.error
+
+  def __write(self, path, parameters, arrays):
+    try:
+      write_checkpoint(path, parameters, arrays)
+      self.written.append(path)
+      while len(self.written) > self.keep:
+        os.remove(self.written.pop(0))
+    except Exception as error:
+      self.error = error
+
+
+def __align(offset: int) -> int:
+  return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
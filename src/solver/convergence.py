@@ -0,0 +1,43 @@
+FIXED_ITERATIONS = 20
+
+
+class Convergence:
+  # Stop iterating once the residual norm relative to the norm of the 
+  # right hand side drops below `tolerance`. The residual is reduced on 
+  # the device before the first iteration and every `check_interval` 
+  # iterations after that, `max_iterations` caps every solve.
+  #
+  # The defaults never run more than the fixed count. In a stirring run
+  # the 20 jacobi sweeps leave the pressure at a relative residual of
+  # about 0.06-0.12 at n=128 and 0.3-0.5 at n=512, while diffusion is
+  # solved to 1e-6 or better within 10 sweeps. A tolerance of 0.1 lets
+  # diffusion and the easier projections exit at 5-10 sweeps, and a solve
+  # that can not get there stops where the fixed count would.
+  def __init__(self, tolerance=0.1, check_interval=5, max_iterations=FIXED_ITERATIONS):
+    self.tolerance = tolerance
+    self.check_interval = check_interval
+    self.max_iterations = max_iterations
+
+  def iterate(self, sweep, residual_norm, rhs_norm):
+    scale = rhs_norm()
+    if scale == 0:
+      scale = 1
+
+    iterations = 0
+    while iterations < self.max_iterations:
+      if iterations % self.check_interval == 0 and residual_norm() <= self.tolerance * scale:
+        break
+      sweep()
+      iterations += 1
+
+    return iterations
+
+
+def iterate(convergence, sweep, residual_norm, rhs_norm):
+  # without a convergence criteria every solve runs the fixed iteration count
+  if convergence is None:
+    for _ in range(FIXED_ITERATIONS):
+      sweep()
+    return FIXED_ITERATIONS
+
+  return convergence.iterate(sweep, residual_norm, rhs_norm)
@@ -1,41 +1,147 @@
+import math
 import taichi as ti
 from .temporal_value_field import TemporalValueField
-from .field_helpers import get_adjacent, contain, nullify_boundary_flow
+from .field_helpers import get_adjacent, cell_count, cell_index, red_black_count, red_black_index, exchange, enforce, reduce_norm, contain, nullify_boundary_flow, apply_walls, norm, inner, zero_sum, is_vector, set_boundary, index, CONTAIN_WALLS, H_VELOCITY_WALLS, V_VELOCITY_WALLS, VELOCITY_WALLS
+from .launch_counter import kernel
+from .convergence import iterate
 
 
-def diffuse_density(n: int, dt: float, viscocity: float, density: TemporalValueField):
+def diffuse_density(n: int, dt: float, viscocity: float, density: TemporalValueField, convergence=None, smoother=None, solver=None, tiles=None, obstacles=None):
   diffusion_rate = dt * viscocity * n * n
-  for _ in range(20):
-    __diffuse_kernel(n, diffusion_rate, density)
-    contain(n, density.current)
+  if solver is not None:
+    return solver.solve(diffusion_rate, [density.current], [density.previous], lambda fields: contain(n, *fields))
 
+  def sweep():
+    __relax(n, diffusion_rate, density, smoother, CONTAIN_WALLS, tiles, obstacles)
 
-def diffuse_velocity(n: int, dt: float, viscocity: float, h_velocity: TemporalValueField, v_velocity: TemporalValueField):
+  def residual_norm():
+    return reduce_norm(tiles, __residual_norm(n, diffusion_rate, density.current, density.previous, tiles))
+
+  def rhs_norm():
+    return norm(n, density.previous, tiles)
+
+  return iterate(convergence, sweep, residual_norm, rhs_norm)
+
+
+def diffuse_velocity(n: int, dt: float, viscocity: float, h_velocity: TemporalValueField, v_velocity: TemporalValueField, convergence=None, smoother=None, solver=None, tiles=None, obstacles=None):
   diffusion_rate = dt * viscocity * n
-  for _ in range(20):
-    __diffuse_kernel(n, diffusion_rate, h_velocity)
-    __diffuse_kernel(n, diffusion_rate, v_velocity)
-    nullify_boundary_flow(n, h_velocity.current, v_velocity.current)
+  if solver is not None:
+    return solver.solve(
+      diffusion_rate, 
+      [h_velocity.current, v_velocity.current], 
+      [h_velocity.previous, v_velocity.previous], 
+      lambda fields: nullify_boundary_flow(n, *fields)
+    )
+
+  def sweep():
+    __relax(n, diffusion_rate, h_velocity, smoother, H_VELOCITY_WALLS, tiles, obstacles)
+    __relax(n, diffusion_rate, v_velocity, smoother, V_VELOCITY_WALLS, tiles, obstacles)
+
+  def residual_norm():
+    return math.hypot(
+      reduce_norm(tiles, __residual_norm(n, diffusion_rate, h_velocity.current, h_velocity.previous, tiles)),
+      reduce_norm(tiles, __residual_norm(n, diffusion_rate, v_velocity.current, v_velocity.previous, tiles))
+    )
+
+  def rhs_norm():
+    return math.hypot(norm(n, h_velocity.previous, tiles), norm(n, v_velocity.previous, tiles))
+
+  return iterate(convergence, sweep, residual_norm, rhs_norm)
+
+
+def diffuse_velocity_vector(n: int, dt: float, viscocity: float, velocity: TemporalValueField, convergence=None, smoother=None, solver=None, tiles=None, obstacles=None):
+  # both components of a vector velocity field relax in the same sweep
+  diffusion_rate = dt * viscocity * n
+  if solver is not None:
+    return solver.solve(diffusion_rate, [velocity.current], [velocity.previous], lambda fields: apply_walls(n, fields[0], VELOCITY_WALLS))
+
+  def sweep():
+    __relax(n, diffusion_rate, velocity, smoother, VELOCITY_WALLS, tiles, obstacles)
+
+  def residual_norm():
+    return reduce_norm(tiles, __residual_norm(n, diffusion_rate, velocity.current, velocity.previous, tiles))
+
+  def rhs_norm():
+    return norm(n, velocity.previous, tiles)
+
+  return iterate(convergence, sweep, residual_norm, rhs_norm)
 
 
-def diffuse(n: int, dt: float, viscocity: float, field: TemporalValueField):
+def diffuse(n: int, dt: float, viscocity: float, field: TemporalValueField, convergence=None, smoother=None, solver=None, tiles=None, obstacles=None):
   diffusion_rate = dt * viscocity * n * n
-  for _ in range(20):
-    __diffuse_kernel(n, diffusion_rate, field)
+  if solver is not None:
+    return solver.solve(diffusion_rate, [field.current], [field.previous], lambda fields: None)
+
+  def sweep():
+    __relax(n, diffusion_rate, field, smoother, None, tiles, obstacles)
+
+  def residual_norm():
+    return reduce_norm(tiles, __residual_norm(n, diffusion_rate, field.current, field.previous, tiles))
+
+  def rhs_norm():
+    return norm(n, field.previous, tiles)
+
+  return iterate(convergence, sweep, residual_norm, rhs_norm)
+
+
+def __relax(n: int, diffusion_rate: float, field: TemporalValueField, smoother, walls, tiles, obstacles):
+  if smoother is None:
+    __diffuse_kernel(n, diffusion_rate, field.current, field.previous, walls, tiles)
+    exchange(tiles, field.current)
+    enforce(obstacles, walls, field.current)
+  else:
+    __diffuse_red_black_kernel(n, diffusion_rate, smoother.omega, 0, field.current, field.previous, walls, tiles)
+    exchange(tiles, field.current)
+    enforce(obstacles, walls, field.current)
+    __diffuse_red_black_kernel(n, diffusion_rate, smoother.omega, 1, field.current, field.previous, walls, tiles)
+    exchange(tiles, field.current)
+    enforce(obstacles, walls, field.current)
   
 
-@ti.kernel
-def __diffuse_kernel(n: int, diffusion_rate: float, tv_field: ti.template()):
+@kernel
+def __diffuse_kernel(n: int, diffusion_rate: float, current: ti.template(), previous: ti.template(), walls: ti.template(), tiles: ti.template()):
   # x = 1; x <= n; n++
-  for i, j in ti.ndrange((1, n + 1), (1, n + 1)):
-    left, right, up, down = get_adjacent(i, j, tv_field.current)
+  for c in range(cell_count(n, tiles)):
+    i, j = cell_index(n, tiles, c)
+    diffuse_cell(n, diffusion_rate, current, previous, i, j, walls)
 
-    surrounding_density = left + right + up + down
-    absorb_diffusion = diffusion_rate * surrounding_density
 
-    prev_density = tv_field.previous[i, j]
-    numerator = prev_density + absorb_diffusion
-    denominator = 1 + 4 * diffusion_rate
+@ti.func
+def diffuse_cell(n, diffusion_rate, current, previous, i, j, walls: ti.template(), member: ti.template() = None):
+  left, right, up, down = get_adjacent(i, j, current, member)
+
+  surrounding_density = left + right + up + down
+  absorb_diffusion = diffusion_rate * surrounding_density
+
+  prev_density = previous[index(i, j, member)]
+  numerator = prev_density + absorb_diffusion
+  denominator = 1 + 4 * diffusion_rate
+
+  value = numerator / denominator
+  current[index(i, j, member)] = value
+  set_boundary(n, current, i, j, value, walls, member)
+
+
+@kernel
+def __diffuse_red_black_kernel(n: int, diffusion_rate: float, omega: float, parity: int, current: ti.template(), previous: ti.template(), walls: ti.template(), tiles: ti.template()):
+  for c in range(red_black_count(n, tiles)):
+    i, j, colour = red_black_index(n, tiles, c, parity)
+    if colour:
+      left, right, up, down = get_adjacent(i, j, current)
+      gauss_seidel = (previous[i, j] + diffusion_rate * (left + right + up + down)) / (1 + 4 * diffusion_rate)
+      value = current[i, j] + omega * (gauss_seidel - current[i, j])
+      current[i, j] = value
+      set_boundary(n, current, i, j, value, walls)
+
+
+@kernel
+def __residual_norm(n: int, diffusion_rate: float, current: ti.template(), previous: ti.template(), tiles: ti.template()) -> ti.f64:
+  total = zero_sum(current)
+  for c in range(cell_count(n, tiles)):
+    i, j = cell_index(n, tiles, c)
+    left, right, up, down = get_adjacent(i, j, current)
+    surrounding_density = left + right + up + down
 
-    tv_field.current[i, j] = numerator / denominator
-    
\ No newline at end of file
+    r = previous[i, j] - ((1 + 4 * diffusion_rate) * current[i, j] - diffusion_rate * surrounding_density)
+    total += inner(r, r, ti.static(is_vector(current)))
+  return ti.sqrt(total)
@@ -0,0 +1,362 @@
+import os
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import taichi as ti
+from .temporal_value_field import TemporalValueField
+from .diffusion import diffuse_density, diffuse_velocity_vector
+from .advection import advect_density_vector, advect_velocity_vector
+from .projection import project_vector
+from .smoothing import RedBlackSOR
+from .field_helpers import add_source, reset_sources, cell_count, cell_index, is_vector
+from .active_tiles import MAX_TILE_SIZE
+from .launch_counter import kernel
+
+# most fields a single `exchange` call refreshes
+MAX_EXCHANGE_FIELDS = 2
+
+
+class DistributedFluidField:
+  # A `FluidField` with a vector velocity split into `workers` slabs of
+  # n // workers rows, each stepped by its own process with its own taichi
+  # fields. Every slab keeps `halo` extra rows on both sides that are
+  # refreshed from its neighbours through shared memory before each
+  # stencil pass, and the convergence checks sum their norms over all
+  # slabs, so every worker takes the same number of iterations.
+  #
+  # The red-black smoothers only read cells the previous half sweep
+  # finished, a split run then follows a `FluidField` with the same
+  # smoothers exactly, with a `Convergence` up to the order sums are
+  # reduced in. The default in place sweeps (a smoother of None) depend
+  # on the order cells are visited in and only match approximately.
+  # Advection backtraces at most `halo` - 1 cells, a step moving fluid
+  # further raises.
+  def __init__(self, n, workers=2, halo=4, arch="cpu", threads=None):
+    if n % workers != 0:
+      raise ValueError(f"{workers} workers do not split n={n} into equal slabs")
+    if not 1 < halo <= n // workers:
+      raise ValueError(f"Halo of {halo} rows does not fit slabs of {n // workers} rows")
+
+    self.n = n
+    self.workers = workers
+    self.halo = halo
+
+    self.viscosity = 0
+    self.diffusion_rate = 0
+
+    self.step_index = 0
+    self.time_step = 0.0
+
+    # same meaning as on `FluidField`
+    self.convergence = None
+    self.diffusion_smoother = RedBlackSOR()
+    self.pressure_smoother = RedBlackSOR()
+    self.iterations = {}
+
+    if threads is None:
+      threads = max(1, (os.cpu_count() or 1) // workers)
+
+    # halo rows every slab shares with its neighbours, and one partial sum per slab
+    self.halo_memory = shared_memory.SharedMemory(create=True, size=int(np.prod(_halo_shape(workers, halo, n))) * 8)
+    self.sum_memory = shared_memory.SharedMemory(create=True, size=workers * 8)
+
+    context = multiprocessing.get_context("spawn")
+    self.barrier = context.Barrier(workers)
+    self.connections = []
+    self.processes = []
+    for rank in range(workers):
+      connection, worker_connection = context.Pipe()
+      process = context.Process(
+        target=_worker,
+        args=(worker_connection, rank, workers, n, halo, arch, threads, self.halo_memory.name, self.sum_memory.name, self.barrier),
+        daemon=True,
+      )
+      process.start()
+      self.connections.append(connection)
+      self.processes.append(process)
+    self.__call("ready")
+
+  def add_density(self, x: int, y: int, radius: int, amount: float):
+    self.__call("add_density", x, y, radius, amount)
+
+  def add_force(self, x: int, y: int, radius: int, h_force: float, v_force: float):
+    self.__call("add_force", x, y, radius, h_force, v_force)
+
+  def reset_fields(self):
+    self.__call("reset_fields")
+
+  def step(self, dt: float):
+    settings = (self.viscosity, self.diffusion_rate, self.convergence, self.diffusion_smoother, self.pressure_smoother)
+    self.iterations = self.__call("step", dt, settings)[0]
+    self.step_index += 1
+    self.time_step = dt
+
+  def gather(self) -> dict:
+    # density of shape (n + 2, n + 2) and velocity of shape (n + 2, n + 2, 2), boundary included
+    size = self.n + 2
+    density = np.zeros((size, size), dtype=np.float32)
+    velocity = np.zeros((size, size, 2), dtype=np.float32)
+    for first_row, slab_density, slab_velocity in self.__call("gather"):
+      density[first_row:first_row + len(slab_density)] = slab_density
+      velocity[first_row:first_row + len(slab_velocity)] = slab_velocity
+    return { "density": density, "velocity": velocity }
+
+  def close(self):
+    if not self.processes:
+      return
+    for connection in self.connections:
+      connection.send(("stop",))
+    for process in self.processes:
+      process.join()
+    self.processes = []
+    self.halo_memory.close()
+    self.halo_memory.unlink()
+    self.sum_memory.close()
+    self.sum_memory.unlink()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    self.close()
+
+  def __call(self, command, *args):
+    for connection in self.connections:
+      connection.send((command, *args))
+
+    replies = [connection.recv() for connection in self.connections]
+    errors = [reply for status, reply in replies if status == "error"]
+    if errors:
+      raise RuntimeError(f"Worker failed:\n{errors[0]}")
+    return [reply for _, reply in replies]
+
+
+@ti.data_oriented
+class Subdomain:
+  # The rows [first_row, end_row) of the interior one worker owns, listed
+  # as square tiles so every tile aware kernel only visits them. Fields of
+  # a slab cover `halo` more rows on both sides and are indexed with the
+  # global row, `exchange` fills those rows from the neighbouring slabs.
+  def __init__(self, rank, workers, n, halo, halo_buffer, sums, barrier):
+    rows = n // workers
+    self.rank = rank
+    self.workers = workers
+    self.n = n
+    self.halo = halo
+    self.first_row = 1 + rank * rows
+    self.end_row = self.first_row + rows
+
+    self.halo_buffer = halo_buffer
+    self.sums = sums
+    self.barrier = barrier
+
+    self.size = max(size for size in range(1, MAX_TILE_SIZE + 1) if rows % size == 0)
+    self.cells = self.size * self.size
+    tile_rows = rows // self.size
+    tile_columns = n // self.size
+    self.tile_list = ti.Vector.field(2, dtype=ti.i32, shape=tile_rows * tile_columns)
+    self.count = ti.field(dtype=ti.i32, shape=())
+    _build_list(rank * tile_rows, tile_columns, self.tile_list, self.count)
+
+  def field_shape(self):
+    return (self.end_row - self.first_row + 2 * self.halo, self.n + 2)
+
+  def field_offset(self):
+    return (self.first_row - self.halo, 0)
+
+  def exchange(self, *fields):
+    slab = self.halo_buffer[self.rank]
+    for index, field in enumerate(fields):
+      _pack(self.first_row, field, slab[0, index])
+      _pack(self.end_row - self.halo, field, slab[1, index])
+    self.barrier.wait()
+
+    for index, field in enumerate(fields):
+      if self.rank > 0:
+        _unpack(self.first_row - self.halo, field, self.halo_buffer[self.rank - 1, 1, index])
+      if self.rank < self.workers - 1:
+        _unpack(self.end_row, field, self.halo_buffer[self.rank + 1, 0, index])
+    # nobody packs the next exchange before every slab has read this one
+    self.barrier.wait()
+
+  def reduce_sum(self, value: float) -> float:
+    return self.__reduce(value).sum()
+
+  def reduce_max(self, value: float) -> float:
+    return self.__reduce(value).max()
+
+  def __reduce(self, value):
+    self.sums[self.rank] = value
+    self.barrier.wait()
+    values = self.sums.copy()
+    self.barrier.wait()
+    return values
+
+  def gather(self, field):
+    # the owned rows of `field` and the boundary rows of the first and last slab
+    first_row = self.first_row - (self.rank == 0)
+    end_row = self.end_row + (self.rank == self.workers - 1)
+    start = first_row - self.field_offset()[0]
+    return first_row, field.to_numpy()[start:start + end_row - first_row]
+
+
+def _halo_shape(workers, halo, n):
+  # (slab, first or last owned rows, field, row, column, component)
+  return (workers, 2, MAX_EXCHANGE_FIELDS, halo, n + 2, 2)
+
+
+def _worker(connection, rank, workers, n, halo, arch, threads, halo_name, sum_name, barrier):
+  ti.init(arch=getattr(ti, arch), cpu_max_num_threads=threads, random_seed=0)
+
+  halo_memory = shared_memory.SharedMemory(name=halo_name)
+  sum_memory = shared_memory.SharedMemory(name=sum_name)
+  halo_buffer = np.ndarray(_halo_shape(workers, halo, n), dtype=np.float64, buffer=halo_memory.buf)
+  sums = np.ndarray(workers, dtype=np.float64, buffer=sum_memory.buf)
+
+  slab = _Slab(Subdomain(rank, workers, n, halo, halo_buffer, sums, barrier))
+  while True:
+    command, *args = connection.recv()
+    if command == "stop":
+      break
+    try:
+      connection.send(("ok", getattr(slab, command)(*args)))
+    except Exception:
+      # the others would wait for this worker at the next barrier forever
+      barrier.abort()
+      connection.send(("error", traceback.format_exc()))
+
+  del halo_buffer, sums
+  halo_memory.close()
+  sum_memory.close()
+
+
+class _Slab:
+  # the fields of one slab and the steps of `FluidField` with a vector velocity over them
+  def __init__(self, subdomain):
+    self.subdomain = subdomain
+    self.n = subdomain.n
+
+    shape = subdomain.field_shape()
+    offset = subdomain.field_offset()
+    self.density = TemporalValueField(shape, float, offset=offset)
+    self.velocity = TemporalValueField(shape, float, 2, offset=offset)
+    self.pressure = ti.field(dtype=float, shape=shape, offset=offset)
+    self.divergence = ti.field(dtype=float, shape=shape, offset=offset)
+
+  def ready(self):
+    return None
+
+  def add_density(self, x, y, radius, amount):
+    _add_splat(self.n, *self.rows(), x, y, radius, self.density.previous, amount)
+
+  def add_force(self, x, y, radius, h_force, v_force):
+    _add_vector_splat(self.n, *self.rows(), x, y, radius, self.velocity.previous, h_force, v_force)
+
+  def rows(self):
+    # global rows the fields of this slab hold
+    offset = self.subdomain.field_offset()[0]
+    return offset, offset + self.subdomain.field_shape()[0]
+
+  def reset_fields(self):
+    reset_sources((self.density.previous, self.velocity.previous))
+
+  def gather(self):
+    first_row, density = self.subdomain.gather(self.density.current)
+    _, velocity = self.subdomain.gather(self.velocity.current)
+    return first_row, density, velocity
+
+  def step(self, dt, settings):
+    viscosity, diffusion_rate, convergence, diffusion_smoother, pressure_smoother = settings
+    n = self.n
+    tiles = self.subdomain
+    iterations = {}
+
+    # sources are spread over the halo rows too, adding them to every
+    # allocated cell keeps the halos in step without an exchange
+    add_source(self.velocity.current, self.velocity.previous, dt, None)
+    self.velocity.swap()
+    iterations["diffuse_velocity"] = diffuse_velocity_vector(n, dt, viscosity, self.velocity, convergence, diffusion_smoother, None, tiles)
+    iterations["project_diffused"] = project_vector(n, self.velocity.current, self.pressure, self.divergence, None, convergence, pressure_smoother, tiles)
+    self.velocity.swap()
+
+    # bounded by the speed in both buffers, advection reads either
+    self.check_backtrace(dt, self.velocity.current, self.velocity.previous)
+    advect_velocity_vector(n, dt, self.velocity, tiles)
+    iterations["project_advected"] = project_vector(n, self.velocity.current, self.pressure, self.divergence, None, convergence, pressure_smoother, tiles)
+
+    add_source(self.density.current, self.density.previous, dt, None)
+    self.density.swap()
+    iterations["diffuse_density"] = diffuse_density(n, dt, diffusion_rate, self.density, convergence, diffusion_smoother, None, tiles)
+    self.density.swap()
+
+    self.check_backtrace(dt, self.velocity.current)
+    advect_density_vector(n, dt, self.density, self.velocity, tiles)
+    return iterations
+
+  def check_backtrace(self, dt, *velocities):
+    speed = max(_max_speed(self.n, velocity, self.subdomain) for velocity in velocities)
+    distance = dt * self.n * self.subdomain.reduce_max(speed)
+    if distance > self.subdomain.halo - 1:
+      raise ValueError(f"Advection backtraces {distance:.2f} cells, more than a halo of {self.subdomain.halo} rows covers")
+
+
+@kernel
+def _build_list(first_tile_row: int, tile_columns: int, tile_list: ti.template(), count: ti.template()):
+  for t in tile_list:
+    tile_list[t] = ti.Vector([first_tile_row + t // tile_columns, t % tile_columns])
+  count[None] = tile_list.shape[0]
+
+
+@kernel
+def _pack(first_row: int, field: ti.template(), rows: ti.types.ndarray()):
+  for k, j in ti.ndrange(rows.shape[0], rows.shape[1]):
+    if ti.static(is_vector(field)):
+      for component in ti.static(range(field.n)):
+        rows[k, j, component] = field[first_row + k, j][component]
+    else:
+      rows[k, j, 0] = field[first_row + k, j]
+
+
+@kernel
+def _unpack(first_row: int, field: ti.template(), rows: ti.types.ndarray()):
+  for k, j in ti.ndrange(rows.shape[0], rows.shape[1]):
+    if ti.static(is_vector(field)):
+      for component in ti.static(range(field.n)):
+        field[first_row + k, j][component] = ti.cast(rows[k, j, component], field.dtype)
+    else:
+      field[first_row + k, j] = ti.cast(rows[k, j, 0], field.dtype)
+
+
+@kernel
+def _max_speed(n: int, velocity: ti.template(), tiles: ti.template()) -> float:
+  speed = 0.0
+  for c in range(cell_count(n, tiles)):
+    i, j = cell_index(n, tiles, c)
+    ti.atomic_max(speed, ti.abs(velocity[i, j]).max())
+  return speed
+
+
+@kernel
+def _add_splat(n: int, first_row: int, end_row: int, x: int, y: int, radius: int, field: ti.template(), value: float):
+  # `add_splat` limited to the rows [first_row, end_row) a slab holds
+  for i, j in ti.ndrange((-radius, radius + 1), (-radius, radius + 1)):
+    if x + i < max(0, first_row) or \
+      x + i >= min(n, end_row) or \
+      y + j < 0 or \
+      y + j >= n:
+      continue
+    if i*i + j*j <= radius*radius:
+      field[x+i, y+j] += value
+
+
+@kernel
+def _add_vector_splat(n: int, first_row: int, end_row: int, x: int, y: int, radius: int, field: ti.template(), h_value: float, v_value: float):
+  for i, j in ti.ndrange((-radius, radius + 1), (-radius, radius + 1)):
+    if x + i < max(0, first_row) or \
+      x + i >= min(n, end_row) or \
+      y + j < 0 or \
+      y + j >= n:
+      continue
+    if i*i + j*j <= radius*radius:
+      field[x+i, y+j] += ti.Vector([h_value, v_value])
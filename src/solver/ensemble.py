@@ -0,0 +1,180 @@
+import taichi as ti
+import numpy as np
+from .temporal_value_field import TemporalValueField
+from .field_helpers import reset_sources, CONTAIN_WALLS, H_VELOCITY_WALLS, V_VELOCITY_WALLS
+from .diffusion import diffuse_cell
+from .advection import advect_cell
+from .projection import init_divergence_and_pressure_cell, develop_pressure_cell, project_cell
+from .convergence import FIXED_ITERATIONS
+from . import launch_counter
+from .launch_counter import kernel
+
+
+@ti.data_oriented
+class FluidEnsemble:
+  # `batch` independent simulations of a `FluidField` with the default
+  # solvers, stored in fields with a leading member axis so every kernel
+  # steps all members in one launch. `viscosity`, `diffusion_rate` and
+  # `time_step` are numpy arrays with a value per member, every member
+  # follows exactly the steps a lone `FluidField` with its values takes.
+  # The kernels pass the member b to the cell functions of the solvers,
+  # which then index (b, i, j). The stencil kernels take n as a template,
+  # splitting the flattened member and cell index then divides by constants.
+  def __init__(self, batch, n):
+    self.batch = batch
+    self.n = n
+
+    self.viscosity = np.zeros(batch)
+    self.diffusion_rate = np.zeros(batch)
+    self.time_step = np.full(batch, 0.1)
+
+    self.step_index = 0
+
+    # kernel launches issued by the last step, shared by all members
+    self.launches = 0
+
+    field_size = n + 2
+    shape = (batch, field_size, field_size)
+
+    self.density = TemporalValueField(shape, float)
+    self.h_velocity = TemporalValueField(shape, float)
+    self.v_velocity = TemporalValueField(shape, float)
+    self.pressure = ti.field(dtype=float, shape=shape)
+    self.divergence = ti.field(dtype=float, shape=shape)
+
+    # per member time step and diffusion rates of the current step
+    self.dt = ti.field(dtype=float, shape=batch)
+    self.density_rate = ti.field(dtype=float, shape=batch)
+    self.velocity_rate = ti.field(dtype=float, shape=batch)
+
+  def reset_fields(self):
+    reset_sources((self.density.previous, self.h_velocity.previous, self.v_velocity.previous))
+
+  def add_density(self, x: int, y: int, radius: int, amount: float, member: int = None):
+    # `member` None adds to every member
+    _add_splat(self.n, -1 if member is None else member, x, y, radius, self.density.previous, amount)
+
+  def add_force(self, x: int, y: int, radius: int, h_force: float, v_force: float, member: int = None):
+    member = -1 if member is None else member
+    if h_force != 0:
+      _add_splat(self.n, member, x, y, radius, self.h_velocity.previous, h_force)
+    if v_force != 0:
+      _add_splat(self.n, member, x, y, radius, self.v_velocity.previous, v_force)
+
+  def results(self) -> dict:
+    # the state of every member as arrays of shape (batch, n + 2, n + 2)
+    return {
+      "density": self.density.current.to_numpy(),
+      "h_velocity": self.h_velocity.current.to_numpy(),
+      "v_velocity": self.v_velocity.current.to_numpy(),
+    }
+
+  def step(self):
+    launches = launch_counter.launches
+    n = self.n
+
+    # the same rates `diffuse_density` and `diffuse_velocity` compute for a lone field
+    self.dt.from_numpy(np.asarray(self.time_step, dtype=np.float32))
+    self.density_rate.from_numpy((self.time_step * self.diffusion_rate * n * n).astype(np.float32))
+    self.velocity_rate.from_numpy((self.time_step * self.viscosity * n).astype(np.float32))
+
+    self.velocity_step()
+    self.density_step()
+
+    self.launches = launch_counter.launches - launches
+    self.step_index += 1
+
+  def density_step(self):
+    n = self.n
+    _add_source(self.dt, self.density.current, self.density.previous)
+
+    self.density.swap()
+    _diffuse(n, self.density_rate, self.density, CONTAIN_WALLS)
+
+    self.density.swap()
+    _advect(n, self.dt, self.density.current, self.density.previous, self.h_velocity.current, self.v_velocity.current, CONTAIN_WALLS)
+
+  def velocity_step(self):
+    n = self.n
+    _add_source(self.dt, self.h_velocity.current, self.h_velocity.previous)
+    _add_source(self.dt, self.v_velocity.current, self.v_velocity.previous)
+
+    self.h_velocity.swap()
+    self.v_velocity.swap()
+    _diffuse(n, self.velocity_rate, self.h_velocity, H_VELOCITY_WALLS)
+    _diffuse(n, self.velocity_rate, self.v_velocity, V_VELOCITY_WALLS)
+
+    self.project()
+
+    self.h_velocity.swap()
+    self.v_velocity.swap()
+
+    # backtraces through the buffer being written, like `advect_velocity` does
+    _advect(n, self.dt, self.h_velocity.current, self.h_velocity.previous, self.h_velocity.current, self.v_velocity.current, H_VELOCITY_WALLS)
+    _advect(n, self.dt, self.v_velocity.current, self.v_velocity.previous, self.h_velocity.current, self.v_velocity.current, V_VELOCITY_WALLS)
+
+    self.project()
+
+  def project(self):
+    n = self.n
+    h = 1.0 / n
+    _init_divergence_and_pressure(n, h, self.h_velocity.current, self.v_velocity.current, self.pressure, self.divergence)
+    for _ in range(FIXED_ITERATIONS):
+      _develop_pressure(n, self.pressure, self.divergence)
+    _project(n, h, self.h_velocity.current, self.v_velocity.current, self.pressure)
+
+
+def _diffuse(n, rate, field, walls):
+  for _ in range(FIXED_ITERATIONS):
+    _diffuse_kernel(n, rate, field.current, field.previous, walls)
+
+
+@kernel
+def _add_source(dt: ti.template(), target: ti.template(), source: ti.template()):
+  for b, i, j in target:
+    target[b, i, j] += dt[b] * source[b, i, j]
+    source[b, i, j] = 0
+
+
+@kernel
+def _add_splat(n: int, member: int, x: int, y: int, radius: int, field: ti.template(), value: float):
+  for b, i, j in ti.ndrange(field.shape[0], (-radius, radius + 1), (-radius, radius + 1)):
+    if member >= 0 and b != member:
+      continue
+    if x + i < 0 or \
+      x + i >= n or \
+      y + j < 0 or \
+      y + j >= n:
+      continue
+    if i*i + j*j <= radius*radius:
+      field[b, x+i, y+j] += value
+
+
+@kernel
+def _diffuse_kernel(n: ti.template(), rate: ti.template(), current: ti.template(), previous: ti.template(), walls: ti.template()):
+  for b, i, j in ti.ndrange(current.shape[0], (1, n + 1), (1, n + 1)):
+    diffuse_cell(n, rate[b], current, previous, i, j, walls, b)
+
+
+@kernel
+def _advect(n: ti.template(), dt: ti.template(), current: ti.template(), previous: ti.template(), h_velocity: ti.template(), v_velocity: ti.template(), walls: ti.template()):
+  for b, i, j in ti.ndrange(current.shape[0], (1, n + 1), (1, n + 1)):
+    advect_cell(n, dt[b] * n, current, previous, h_velocity, v_velocity, i, j, walls, b)
+
+
+@kernel
+def _init_divergence_and_pressure(n: ti.template(), h: float, h_velocity: ti.template(), v_velocity: ti.template(), pressure: ti.template(), divergence: ti.template()):
+  for b, i, j in ti.ndrange(pressure.shape[0], (1, n + 1), (1, n + 1)):
+    init_divergence_and_pressure_cell(n, h, h_velocity, v_velocity, pressure, divergence, i, j, b)
+
+
+@kernel
+def _develop_pressure(n: ti.template(), pressure: ti.template(), divergence: ti.template()):
+  for b, i, j in ti.ndrange(pressure.shape[0], (1, n + 1), (1, n + 1)):
+    develop_pressure_cell(n, pressure, divergence, i, j, b)
+
+
+@kernel
+def _project(n: ti.template(), h: float, h_velocity: ti.template(), v_velocity: ti.template(), pressure: ti.template()):
+  for b, i, j in ti.ndrange(pressure.shape[0], (1, n + 1), (1, n + 1)):
+    project_cell(n, h, h_velocity, v_velocity, pressure, i, j, b)
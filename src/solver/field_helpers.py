@@ -1,25 +1,240 @@
+import math
 import taichi as ti
 import taichi.math as tim
+from .launch_counter import kernel
+
+# signs the (left/right, bottom/top) walls mirror a cell with,
+# matching `contain` and both halves of `nullify_boundary_flow`,
+# a vector field takes one sign per component
+CONTAIN_WALLS = (1, 1)
+H_VELOCITY_WALLS = (-1, 1)
+V_VELOCITY_WALLS = (1, -1)
+VELOCITY_WALLS = ((-1, 1), (1, -1))
+
+
+def is_vector(field) -> bool:
+  return isinstance(field, ti.MatrixField)
+
+
+def new_field(dtype, shape, components=None, layout=ti.Layout.AOS, offset=None, builder=None):
+  # A scalar field, or a vector field of `components` stored in `layout`.
+  # With a `ti.FieldsBuilder` it is placed in the builder's tree, which 
+  # can be destroyed to release it, otherwise in the default root.
+  if builder is None:
+    if components is None:
+      return ti.field(dtype=dtype, shape=shape, offset=offset)
+    return ti.Vector.field(components, dtype=dtype, shape=shape, layout=layout, offset=offset)
+
+  field = ti.field(dtype=dtype) if components is None else ti.Vector.field(components, dtype=dtype)
+  shape = (shape,) if isinstance(shape, int) else tuple(shape)
+  if not shape:
+    builder.place(field)
+  elif components is not None and layout == ti.Layout.SOA:
+    for component in range(components):
+      builder.dense(ti.axes(*range(len(shape))), shape).place(field.get_scalar_field(component), offset=offset)
+  else:
+    builder.dense(ti.axes(*range(len(shape))), shape).place(field, offset=offset)
+  return field
+
+
+def field_like(field, dtype=None, builder=None):
+  dtype = field.dtype if dtype is None else dtype
+  return new_field(dtype, field.shape, field.n if is_vector(field) else None, builder=builder)
+
+
+def is_tiled(tiles) -> bool:
+  return tiles is not None
+
+
+def is_batched(member) -> bool:
+  return member is not None
+
+
+@ti.func
+def index(i, j, member: ti.template()):
+  # index of cell (i, j), prefixed by `member` for fields with a leading
+  # member axis. The cell functions take the member last, None by default
+  if ti.static(is_batched(member)):
+    return ti.Vector([member, i, j])
+  else:
+    return ti.Vector([i, j])
+
+
+@ti.func
+def cell_count(n, tiles: ti.template()):
+  # interior cells a kernel visits, loop `for c in range(cell_count(n, tiles))`
+  # and map c with `cell_index`, `tiles` are `ActiveTiles` or None for every cell
+  count = n * n
+  if ti.static(is_tiled(tiles)):
+    count = tiles.count[None] * tiles.cells
+  return count
+
+
+@ti.func
+def cell_index(n, tiles: ti.template(), c):
+  # without tiles this is the row major order of ti.ndrange((1, n + 1), (1, n + 1))
+  i = 1 + c // n
+  j = 1 + c % n
+  if ti.static(is_tiled(tiles)):
+    tile = tiles.tile_list[c // tiles.cells]
+    k = c % tiles.cells
+    i = 1 + tile[0] * tiles.size + k // tiles.size
+    j = 1 + tile[1] * tiles.size + k % tiles.size
+  return i, j
+
+
+@ti.func
+def red_black_count(n, tiles: ti.template()):
+  # like `cell_count`, for the cells of one colour of a red-black sweep
+  count = n * ((n + 1) // 2)
+  if ti.static(is_tiled(tiles)):
+    count = cell_count(n, tiles)
+  return count
+
+
+@ti.func
+def red_black_index(n, tiles: ti.template(), c, parity):
+  # (i, j) and whether that cell has colour `parity`, (i + j) % 2 == parity
+  half = (n + 1) // 2
+  i = 1 + c // half
+  j = red_black_column(i, c % half, parity)
+  if ti.static(is_tiled(tiles)):
+    i, j = cell_index(n, tiles, c)
+  return i, j, j <= n and (i + j) % 2 == parity
+
+
+def exchange(tiles, *fields):
+  # refresh the halo cells of `fields` when the tiles are one part of a split domain
+  if tiles is not None:
+    tiles.exchange(*fields)
+
+
+def enforce(obstacles, walls, *fields):
+  # set the boundary cells of internal `Obstacles` once a pass wrote `fields`
+  if obstacles is not None:
+    obstacles.apply(walls, *fields)
+
+
+def reduce_sum(tiles, value: float) -> float:
+  # sum of `value` over every part of a split domain
+  return value if tiles is None else tiles.reduce_sum(value)
+
+
+def reduce_norm(tiles, value: float) -> float:
+  return value if tiles is None else math.sqrt(tiles.reduce_sum(value * value))
 
 
 @ti.func
-def get_adjacent(i, j, source):
-  left = source[i - 1, j]
-  right = source[i + 1, j]
-  up = source[i, j + 1]
-  down = source[i, j - 1]
+def get_adjacent(i, j, source, member: ti.template() = None):
+  # scaling by 1.0 promotes half precision neighbours, so stencil sums accumulate in f32
+  left = 1.0 * source[index(i - 1, j, member)]
+  right = 1.0 * source[index(i + 1, j, member)]
+  up = 1.0 * source[index(i, j + 1, member)]
+  down = 1.0 * source[index(i, j - 1, member)]
 
   return (left, right, up, down)
 
 
-@ti.kernel
-def add_source(target: ti.template(), source: ti.template(), dt: float):
-  for i, j in target:
-    target[i, j] += dt * source[i, j]
-    source[i, j] = 0
+@ti.func
+def mirror(sign: ti.template(), value):
+  if ti.static(isinstance(sign, tuple)):
+    return ti.Vector(sign) * value
+  else:
+    return sign * value
+
 
+@ti.func
+def inner(a, b, vector: ti.template()):
+  # dot product of two values of a scalar or a vector field
+  # promoted first, products of small half precision values underflow
+  if ti.static(vector):
+    return (1.0 * a).dot(b)
+  else:
+    return (1.0 * a) * b
 
-@ti.kernel
+
+@ti.func
+def zero_sum(field: ti.template()):
+  # the zero a sum over `field` starts from, f64 for f64 fields and f32
+  # for anything narrower, so wide fields are not added up in f32
+  return 1.0 * ti.cast(0, field.dtype)
+
+
+@ti.func
+def set_boundary(n, field, i, j, value, walls: ti.template(), member: ti.template() = None):
+  # Mirror the freshly written interior cell (i, j) into the boundary 
+  # cells that only depend on it. Once every interior cell has run this 
+  # matches `contain` or `nullify_boundary_flow`, so stencil kernels can 
+  # update the boundary in the same pass. `walls` of None leaves it alone.
+  if ti.static(walls):
+    if i == 1:
+      field[index(0, j, member)] = mirror(walls[0], value)
+    if i == n:
+      field[index(n + 1, j, member)] = mirror(walls[0], value)
+    if j == 1:
+      field[index(i, 0, member)] = mirror(walls[1], value)
+    if j == n:
+      field[index(i, n + 1, member)] = mirror(walls[1], value)
+
+    if (i == 1 or i == n) and (j == 1 or j == n):
+      corner_i = ti.select(i == 1, 0, n + 1)
+      corner_j = ti.select(j == 1, 0, n + 1)
+      field[index(corner_i, corner_j, member)] = 0.5 * (mirror(walls[1], value) + mirror(walls[0], value))
+
+
+@ti.func
+def red_black_column(i, k, parity):
+  # k-th column of row i with a colour (i + j) % 2 equal to parity,
+  # iterate k over (n + 1) // 2 and skip columns past n
+  return 2 * k + 1 + (i + 1 + parity) % 2
+
+
+@kernel
+def add_source(target: ti.template(), source: ti.template(), dt: float, tiles: ti.template()):
+  if ti.static(is_tiled(tiles)):
+    for c in range(cell_count(tiles.n, tiles)):
+      i, j = cell_index(tiles.n, tiles, c)
+      target[i, j] += dt * source[i, j]
+      source[i, j] = 0
+  else:
+    for i, j in target:
+      target[i, j] += dt * source[i, j]
+      source[i, j] = 0
+
+
+@kernel
+def add_splat(n: int, x: int, y: int, radius: int, field: ti.template(), value: float):
+  for i, j in ti.ndrange((-radius, radius + 1), (-radius, radius + 1)):
+    if x + i < 0 or \
+      x + i >= n or \
+      y + j < 0 or \
+      y + j >= n:
+      continue
+    # add in radius around (x, y)
+    if i*i + j*j <= radius*radius:
+      field[x+i, y+j] += value
+
+
+@kernel
+def add_vector_splat(n: int, x: int, y: int, radius: int, field: ti.template(), h_value: float, v_value: float):
+  for i, j in ti.ndrange((-radius, radius + 1), (-radius, radius + 1)):
+    if x + i < 0 or \
+      x + i >= n or \
+      y + j < 0 or \
+      y + j >= n:
+      continue
+    if i*i + j*j <= radius*radius:
+      field[x+i, y+j] += ti.Vector([h_value, v_value])
+
+
+@kernel
+def reset_sources(fields: ti.template()):
+  for I in ti.grouped(fields[0]):
+    for field in ti.static(fields):
+      field[I] = 0
+
+
+@kernel
 def contain(n: int, field: ti.template()):
   for i in ti.ndrange((1, n + 1)):
     """ # wrap
@@ -40,7 +255,7 @@ def contain(n: int, field: ti.template()):
 
 
 @ti.func
-def bilinear_interpolate_nearest(x, y, field):
+def bilinear_interpolate_nearest(x, y, field, member: ti.template() = None):
   i0 = int(x)
   j0 = int(y)
   i1 = i0 + 1
@@ -52,14 +267,14 @@ def bilinear_interpolate_nearest(x, y, field):
   bottom_weight = 1 - top_weight
   
   interpolated_value = (
-    left_weight * (bottom_weight * field[i0, j0] + top_weight * field[i0, j1]) + \
-    right_weight * (bottom_weight * field[i1, j0] + top_weight * field[i1, j1])
+    left_weight * (bottom_weight * field[index(i0, j0, member)] + top_weight * field[index(i0, j1, member)]) + \
+    right_weight * (bottom_weight * field[index(i1, j0, member)] + top_weight * field[index(i1, j1, member)])
   )
 
   return interpolated_value
 
 
-@ti.kernel
+@kernel
 def nullify_boundary_flow(n: int, h_velocity: ti.template(), v_velocity: ti.template()):
 
   for i in ti.ndrange((1, n + 1)):
@@ -94,3 +309,69 @@ def nullify_boundary_flow(n: int, h_velocity: ti.template(), v_velocity: ti.temp
   v_velocity[x0,y1] = 0.5 * (v_velocity[1, n + 1] + v_velocity[0, n])
   v_velocity[x1,y0] = 0.5 * (v_velocity[n, 0]     + v_velocity[n + 1, 1])
   v_velocity[x1,y1] = 0.5 * (v_velocity[n, n + 1] + v_velocity[n + 1, n])
+
+
+@kernel
+def apply_walls(n: int, field: ti.template(), walls: ti.template()):
+  # `contain` / `nullify_boundary_flow` for any field and walls
+  for i in ti.ndrange((1, n + 1)):
+    field[0, i] = mirror(walls[0], field[1, i])
+    field[n + 1, i] = mirror(walls[0], field[n, i])
+    field[i, 0] = mirror(walls[1], field[i, 1])
+    field[i, n + 1] = mirror(walls[1], field[i, n])
+
+  field[0, 0] =     0.5 * (field[1, 0] + field[0, 1])
+  field[0, n + 1] = 0.5 * (field[1, n + 1] + field[0, n])
+  field[n + 1, 0] = 0.5 * (field[n, 0] + field[n + 1, 1])
+  field[n + 1, n + 1] = 0.5 * (field[n, n + 1] + field[n + 1, n])
+
+
+def max_abs(n: int, field, tiles=None) -> float:
+  # largest magnitude of any interior value or vector component
+  return __max_abs(n, field, tiles)
+
+
+def norm(n: int, field, tiles=None) -> float:
+  return reduce_norm(tiles, __norm(n, field, tiles))
+
+
+def remove_mean(n: int, field, tiles=None):
+  total = reduce_sum(tiles, __sum(n, field, tiles))
+  __subtract(n, field, total / (n * n), tiles)
+
+
+@kernel
+def __max_abs(n: int, field: ti.template(), tiles: ti.template()) -> float:
+  result = 0.0
+  for c in range(cell_count(n, tiles)):
+    i, j = cell_index(n, tiles, c)
+    if ti.static(is_vector(field)):
+      ti.atomic_max(result, ti.abs(1.0 * field[i, j]).max())
+    else:
+      ti.atomic_max(result, ti.abs(1.0 * field[i, j]))
+  return result
+
+
+@kernel
+def __norm(n: int, field: ti.template(), tiles: ti.template()) -> ti.f64:
+  total = zero_sum(field)
+  for c in range(cell_count(n, tiles)):
+    i, j = cell_index(n, tiles, c)
+    total += inner(field[i, j], field[i, j], ti.static(is_vector(field)))
+  return ti.sqrt(total)
+
+
+@kernel
+def __sum(n: int, field: ti.template(), tiles: ti.template()) -> ti.f64:
+  total = zero_sum(field)
+  for c in range(cell_count(n, tiles)):
+    i, j = cell_index(n, tiles, c)
+    total += field[i, j]
+  return total
+
+
+@kernel
+def __subtract(n: int, field: ti.template(), value: ti.f64, tiles: ti.template()):
+  for c in range(cell_count(n, tiles)):
+    i, j = cell_index(n, tiles, c)
+    field[i, j] -= ti.cast(value, field.dtype)
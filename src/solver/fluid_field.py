@@ -1,63 +1,446 @@
+import math
+from contextlib import nullcontext
 import taichi as ti
 import taichi.math as tim
-from .diffusion import diffuse_density, diffuse_velocity
-from .advection import advect_density, advect_velocity
-from .projection import project
+from taichi.lang.util import to_numpy_type
+import numpy as np
+from .diffusion import diffuse_density, diffuse_velocity, diffuse_velocity_vector
+from .advection import advect_density, advect_velocity, advect_density_vector, advect_velocity_vector
+from .projection import project, project_vector
+from .multigrid import MultigridSolver
+from .spectral import SpectralSolver
+from .conjugate_gradient import ConjugateGradientSolver
 from .temporal_value_field import TemporalValueField
-from .field_helpers import add_source
+from .field_helpers import add_source, add_splat, add_vector_splat, reset_sources, max_abs, new_field, is_vector
+from .checkpoint import save_checkpoint, load_checkpoint, snapshot, restore
+from .splat_queue import stroke_points
+from . import launch_counter
+
+NO_STAGE = nullcontext()
+
+# "split" keeps a scalar field per velocity component, "aos" and "soa" 
+# store both components in one vector field with that memory layout
+VELOCITY_LAYOUTS = {
+  "aos": ti.Layout.AOS,
+  "soa": ti.Layout.SOA,
+}
+
+# storage type of the solver fields, None keeps the default float of ti.init
+PRECISIONS = {
+  None: float,
+  "f16": ti.f16,
+  "f32": ti.f32,
+  "f64": ti.f64,
+}
 
 @ti.data_oriented
 class FluidField:
-  def __init__(self, n):
+  def __init__(self, n, pressure_solver="jacobi", diffusion_solver="relaxation", velocity_layout="split", precision=None, builder=None):
     self.n = n
 
     self.viscosity = 0
     self.diffusion_rate = 0
 
+    # steps taken so far and the dt of the last one
+    self.step_index = 0
+    self.time_step = 0.0
+
+    # calls to `advance` so far, each one step or a few substeps
+    self.frame_index = 0
+
+    # None runs every diffusion and jacobi pressure solve for a fixed 
+    # number of iterations, a `Convergence` stops them at a tolerance
+    self.convergence = None
+
+    # None keeps the in place jacobi style sweeps, 
+    # a `RedBlackSOR` relaxes in red-black order with its own factor
+    self.diffusion_smoother = None
+    self.pressure_smoother = None
+
+    # iterations used by every solve of the last step
+    self.iterations = {}
+
+    # kernel launches issued by the last step
+    self.launches = 0
+
+    # a `StageProfiler` records timings of every stage of `step`
+    self.profiler = None
+
+    # an `AsyncCheckpointer` saves the state every few steps
+    self.checkpointer = None
+
+    # `ActiveTiles` restrict the stencil kernels to the tiles holding fluid
+    self.active_tiles = None
+
+    # `Obstacles` add solid cells inside the box, their boundary cells are
+    # set after every pass, only the relaxation solvers support them
+    self.obstacles = None
+
+    # None steps `advance` with the dt it is given, a CFL number splits it
+    # into the fewest substeps whose backtraces stay within `cfl` cells,
+    # at most `max_substeps` of them
+    self.cfl = None
+    self.max_substeps = 16
+
+    # substeps the last `advance` took
+    self.substeps = 0
+
+    # a `SplatQueue` collects the sources and adds them to the cells under
+    # them, None splats into the source buffers that every step sweeps
+    self.source_queue = None
+
     self.boundry_layer = 2
     field_size = n + self.boundry_layer
 
-    self.density = TemporalValueField((field_size, field_size), float)
-    self.h_velocity = TemporalValueField((field_size, field_size), float)
-    self.v_velocity = TemporalValueField((field_size, field_size), float)
-    self.pressure = ti.field(dtype=float, shape=(field_size, field_size))
-    self.divergence = ti.field(dtype=float, shape=(field_size, field_size))
+    # Fields are stored in `dtype`. Kernels compute in the wider of it and 
+    # the arguments they take, so half precision fields still accumulate in
+    # f32. Solver work fields use `work_dtype`, which never goes below f32.
+    if precision not in PRECISIONS:
+      raise ValueError(f"Unknown precision '{precision}'")
+    self.precision = precision
+    self.dtype = PRECISIONS[precision]
+    self.work_dtype = ti.f32 if self.dtype == ti.f16 else self.dtype
+    dtype = self.dtype
+
+    # with a `ti.FieldsBuilder` every field of the solver is placed in its 
+    # tree, destroying the finalized tree releases them all
+    shape = (field_size, field_size)
+    self.density = TemporalValueField(shape, dtype, builder=builder)
+
+    # either `velocity` or `h_velocity` and `v_velocity` exist, the other is None
+    self.velocity_layout = velocity_layout
+    if velocity_layout == "split":
+      self.velocity = None
+      self.h_velocity = TemporalValueField(shape, dtype, builder=builder)
+      self.v_velocity = TemporalValueField(shape, dtype, builder=builder)
+    elif velocity_layout in VELOCITY_LAYOUTS:
+      self.velocity = TemporalValueField(shape, dtype, 2, VELOCITY_LAYOUTS[velocity_layout], builder=builder)
+      self.h_velocity = None
+      self.v_velocity = None
+    else:
+      raise ValueError(f"Unknown velocity layout '{velocity_layout}'")
+
+    self.pressure = new_field(dtype, shape, builder=builder)
+    self.divergence = new_field(dtype, shape, builder=builder)
+
+    # "jacobi" keeps the fixed 20 sweeps in `project`, 
+    # "multigrid" solves down to `self.pressure_solver.tolerance`,
+    # "spectral" solves exactly with cosine transforms
+    if pressure_solver == "jacobi":
+      self.pressure_solver = None
+    elif pressure_solver == "multigrid":
+      self.pressure_solver = MultigridSolver(n, dtype=self.work_dtype, builder=builder)
+    elif pressure_solver == "spectral":
+      self.pressure_solver = SpectralSolver(n, dtype=self.work_dtype)
+    else:
+      raise ValueError(f"Unknown pressure solver '{pressure_solver}'")
+
+    # "relaxation" runs the diffusion sweeps, "conjugate_gradient" 
+    # solves down to `self.diffusion_solver.tolerance`
+    if diffusion_solver == "relaxation":
+      self.diffusion_solver = None
+    elif diffusion_solver == "conjugate_gradient":
+      self.diffusion_solver = ConjugateGradientSolver(n, dtype=self.work_dtype, builder=builder)
+      if builder is not None:
+        # nothing can be added to the tree once it is finalized
+        self.diffusion_solver.reserve([self.density.current])
+        self.diffusion_solver.reserve(self.__velocity_fields())
+    else:
+      raise ValueError(f"Unknown diffusion solver '{diffusion_solver}'")
 
-  @ti.kernel
   def reset_fields(self):
-    for i, j in self.density.previous:
-      self.density.previous[i, j] = 0
-      self.h_velocity.previous[i, j] = 0
-      self.v_velocity.previous[i, j] = 0
+    if self.source_queue is not None:
+      self.source_queue.clear()
+    elif self.velocity is None:
+      reset_sources((self.density.previous, self.h_velocity.previous, self.v_velocity.previous))
+    else:
+      reset_sources((self.density.previous, self.velocity.previous))
+
+  def add_density(self, x: int, y: int, radius: int, amount: float):
+    if self.source_queue is not None:
+      self.source_queue.add(x, y, radius, density=amount)
+    else:
+      add_splat(self.n, x, y, radius, self.density.previous, amount)
+    if self.active_tiles is not None:
+      self.active_tiles.activate(x, y, radius)
+
+  def add_force(self, x: int, y: int, radius: int, h_force: float, v_force: float):
+    if self.active_tiles is not None:
+      self.active_tiles.activate(x, y, radius)
+    if self.source_queue is not None:
+      self.source_queue.add(x, y, radius, h_force=h_force, v_force=v_force)
+      return
+    if self.velocity is not None:
+      add_vector_splat(self.n, x, y, radius, self.velocity.previous, h_force, v_force)
+      return
+    if h_force != 0:
+      add_splat(self.n, x, y, radius, self.h_velocity.previous, h_force)
+    if v_force != 0:
+      add_splat(self.n, x, y, radius, self.v_velocity.previous, v_force)
+
+  def add_stroke(self, x0: int, y0: int, x1: int, y1: int, radius: int, amount: float = 0, h_force: float = 0, v_force: float = 0):
+    # splats along the segment a cursor moved since its last sample, sharing the amounts of one splat
+    if self.source_queue is not None:
+      self.source_queue.add_stroke(x0, y0, x1, y1, radius, amount, h_force, v_force)
+      if self.active_tiles is not None:
+        for x, y in stroke_points(x0, y0, x1, y1, radius):
+          self.active_tiles.activate(x, y, radius)
+      return
+
+    points = stroke_points(x0, y0, x1, y1, radius)
+    for x, y in points:
+      if amount != 0:
+        self.add_density(x, y, radius, amount / len(points))
+      if h_force != 0 or v_force != 0:
+        self.add_force(x, y, radius, h_force / len(points), v_force / len(points))
+
+  def step(self, dt: float, source_dt: float = None):
+    # sources are scaled by `source_dt`, `dt` when None
+    if source_dt is None:
+      source_dt = dt
+    launches = launch_counter.launches
+    if self.profiler is not None:
+      self.profiler.begin_step()
+
+    if self.active_tiles is not None:
+      with self.__stage("update_tiles"):
+        self.active_tiles.update(self.__temporal_fields(), (self.pressure, self.divergence))
+
+    if self.obstacles is not None:
+      with self.__stage("update_obstacles"):
+        self.__update_obstacles()
+
+    if self.source_queue is not None:
+      with self.__stage("apply_splats"):
+        self.source_queue.apply(self.n, source_dt, self.density.current, self.__velocity_fields())
+
+    self.velocity_step(dt, source_dt)
+    self.density_step(dt, source_dt)
+
+    self.launches = launch_counter.launches - launches
+    if self.profiler is not None:
+      self.profiler.end_step(self.iterations, self.bytes_touched())
+
+    self.step_index += 1
+    self.time_step = dt
+    if self.checkpointer is not None:
+      self.checkpointer.after_step(self)
+
+  def advance(self, frame_dt: float):
+    # step `frame_dt` forward, the sources of the frame are added once before the first substep
+    self.frame_index += 1
+    if self.cfl is None:
+      self.step(frame_dt)
+      self.substeps = 1
+      return
+
+    # the first stable dt has to see the velocity the sources leave,
+    # a strong force on a still fluid would otherwise take one full step
+    self.__add_sources(frame_dt)
+
+    remaining = frame_dt
+    self.substeps = 0
+    while remaining > 0:
+      # the velocity changes every substep, so the stable dt is taken again each time
+      substeps_left = self.max_substeps - self.substeps
+      count = max(1, min(substeps_left, math.ceil(remaining / self.stable_time_step())))
+      dt = remaining / count
+      self.step(dt)
+      self.substeps += 1
+      remaining = 0 if count == 1 else remaining - dt
+      if remaining > 0:
+        # a step leaves the source buffers holding scratch values, like the caller does after a frame
+        self.reset_fields()
+
+  def __add_sources(self, source_dt: float):
+    # what the start of `step` adds, leaving the source buffers and queue empty for it
+    if self.active_tiles is not None:
+      self.active_tiles.update(self.__temporal_fields(), (self.pressure, self.divergence))
+    if self.source_queue is not None:
+      self.source_queue.apply(self.n, source_dt, self.density.current, self.__velocity_fields())
+      return
+    add_source(self.density.current, self.density.previous, source_dt, self.active_tiles)
+    for velocity in (self.velocity, self.h_velocity, self.v_velocity):
+      if velocity is not None:
+        add_source(velocity.current, velocity.previous, source_dt, self.active_tiles)
+
+  def __update_obstacles(self):
+    if self.pressure_solver is not None or self.diffusion_solver is not None:
+      raise ValueError("Obstacles need the jacobi pressure solver and relaxation diffusion")
+    if self.obstacles.update():
+      # a changed mask clears whatever the new solid cells held
+      self.obstacles.zero(*self.__temporal_fields(), self.pressure)
+
+  def stable_time_step(self) -> float:
+    # largest dt whose backtrace moves at most `cfl` cells along each axis
+    speed = max(max_abs(self.n, field, self.active_tiles) for field in self.__velocity_fields())
+    if speed == 0:
+      return math.inf
+    return self.cfl / (self.n * speed)
+
+  def __velocity_fields(self):
+    if self.velocity is None:
+      return (self.h_velocity.current, self.v_velocity.current)
+    return (self.velocity.current,)
+
+  def __temporal_fields(self):
+    fields = [self.density.current, self.density.previous]
+    for velocity in (self.velocity, self.h_velocity, self.v_velocity):
+      if velocity is not None:
+        fields += [velocity.current, velocity.previous]
+    return fields
+
+  def save_checkpoint(self, path: str):
+    save_checkpoint(self, path)
+
+  def load_checkpoint(self, path: str):
+    load_checkpoint(self, path)
+    if self.active_tiles is not None:
+      self.active_tiles.rescan = True
+
+  def warm_up(self, dt: float = 0.1):
+    # Compile every kernel a step with the current settings launches by
+    # stepping once and restoring the state afterwards. Taichi's offline
+    # cache keeps the compiled kernels, so later processes stepping a field
+    # of the same size and settings skip compilation.
+    state = snapshot(self)
+    iterations, launches, profiler, checkpointer = self.iterations, self.launches, self.profiler, self.checkpointer
+    self.profiler = None
+    self.checkpointer = None
+
+    substeps = self.substeps
+
+    self.add_density(1, 1, 1, 1)
+    self.add_force(1, 1, 1, 1, 1)
+    # `advance` also compiles the speed reduction substepping needs
+    self.advance(dt)
+    self.reset_fields()
+
+    restore(self, *state)
+    self.iterations, self.launches, self.profiler, self.checkpointer = iterations, launches, profiler, checkpointer
+    self.substeps = substeps
+    if self.active_tiles is not None:
+      self.active_tiles.rescan = True
+    ti.sync()
+
+  def density_step(self, dt: float, source_dt: float = None):
+    source_dt = dt if source_dt is None else source_dt
+    if self.source_queue is None:
+      with self.__stage("density_add_source"):
+        add_source(self.density.current, self.density.previous, source_dt, self.active_tiles)
+
+    with self.__stage("swap"):
+      self.density.swap()
+    with self.__stage("diffuse_density"):
+      self.iterations["diffuse_density"] = diffuse_density(self.n, dt, self.diffusion_rate, self.density, self.convergence, self.diffusion_smoother, self.diffusion_solver, self.active_tiles, self.obstacles)
+
+    with self.__stage("swap"):
+      self.density.swap()
+    with self.__stage("advect_density"):
+      if self.velocity is None:
+        advect_density(self.n, dt, self.density, self.h_velocity, self.v_velocity, self.active_tiles, self.obstacles)
+      else:
+        advect_density_vector(self.n, dt, self.density, self.velocity, self.active_tiles, self.obstacles)
+
+  def velocity_step(self, dt: float, source_dt: float = None):
+    source_dt = dt if source_dt is None else source_dt
+    if self.velocity is not None:
+      self.__vector_velocity_step(dt, source_dt)
+      return
+
+    if self.source_queue is None:
+      with self.__stage("velocity_add_source"):
+        add_source(self.h_velocity.current, self.h_velocity.previous, source_dt, self.active_tiles)
+        add_source(self.v_velocity.current, self.v_velocity.previous, source_dt, self.active_tiles)
+
+    with self.__stage("swap"):
+      self.h_velocity.swap()
+      self.v_velocity.swap()
+    with self.__stage("diffuse_velocity"):
+      self.iterations["diffuse_velocity"] = diffuse_velocity(self.n, dt, self.viscosity, self.h_velocity, self.v_velocity, self.convergence, self.diffusion_smoother, self.diffusion_solver, self.active_tiles, self.obstacles)
+
+    with self.__stage("project_diffused"):
+      self.iterations["project_diffused"] = project(self.n, self.h_velocity.current, self.v_velocity.current, self.pressure, self.divergence, self.pressure_solver, self.convergence, self.pressure_smoother, self.active_tiles, self.obstacles)
+
+    with self.__stage("swap"):
+      self.h_velocity.swap()
+      self.v_velocity.swap()
+
+    with self.__stage("advect_velocity"):
+      advect_velocity(self.n, dt, self.h_velocity, self.v_velocity, self.h_velocity, self.v_velocity, self.active_tiles, self.obstacles)	
+
+    with self.__stage("project_advected"):
+      self.iterations["project_advected"] = project(self.n, self.h_velocity.current, self.v_velocity.current, self.pressure, self.divergence, self.pressure_solver, self.convergence, self.pressure_smoother, self.active_tiles, self.obstacles)
+
+  def __vector_velocity_step(self, dt: float, source_dt: float):
+    if self.source_queue is None:
+      with self.__stage("velocity_add_source"):
+        add_source(self.velocity.current, self.velocity.previous, source_dt, self.active_tiles)
+
+    with self.__stage("swap"):
+      self.velocity.swap()
+    with self.__stage("diffuse_velocity"):
+      self.iterations["diffuse_velocity"] = diffuse_velocity_vector(self.n, dt, self.viscosity, self.velocity, self.convergence, self.diffusion_smoother, self.diffusion_solver, self.active_tiles, self.obstacles)
+
+    with self.__stage("project_diffused"):
+      self.iterations["project_diffused"] = project_vector(self.n, self.velocity.current, self.pressure, self.divergence, self.pressure_solver, self.convergence, self.pressure_smoother, self.active_tiles, self.obstacles)
+
+    with self.__stage("swap"):
+      self.velocity.swap()
 
-  def step(self, dt: float):
-    self.velocity_step(dt)
-    self.density_step(dt)
+    with self.__stage("advect_velocity"):
+      advect_velocity_vector(self.n, dt, self.velocity, self.active_tiles, self.obstacles)
 
-  def density_step(self, dt: float):
-    add_source(self.density.current, self.density.previous, dt)
+    with self.__stage("project_advected"):
+      self.iterations["project_advected"] = project_vector(self.n, self.velocity.current, self.pressure, self.divergence, self.pressure_solver, self.convergence, self.pressure_smoother, self.active_tiles, self.obstacles)
 
-    self.density.swap()
-    diffuse_density(self.n, dt, self.diffusion_rate, self.density)
+  def memory_bytes(self):
+    # bytes held by the density, velocity, pressure and divergence fields
+    fields = self.__temporal_fields() + [self.pressure, self.divergence]
+    return sum(np.prod(field.shape) * (field.n if is_vector(field) else 1) * np.dtype(to_numpy_type(field.dtype)).itemsize for field in fields)
 
-    self.density.swap()
-    advect_density(self.n, dt, self.density, self.h_velocity, self.v_velocity)
+  def bytes_touched(self):
+    # Estimated memory traffic of every stage of the last step, counting 
+    # each field a kernel reads or writes as one pass over the grid. 
+    # Boundary updates are folded into the stencil kernels and swaps are free.
+    field_bytes = self.density.current.shape[0] * self.density.current.shape[1] * np.dtype(to_numpy_type(self.pressure.dtype)).itemsize
+    if self.active_tiles is not None:
+      # tile aware kernels only pass over the active tiles
+      field_bytes *= self.active_tiles.fraction()
 
-  def velocity_step(self, dt: float):
-    add_source(self.h_velocity.current, self.h_velocity.previous, dt)
-    add_source(self.v_velocity.current, self.v_velocity.previous, dt)
+    diffusion_passes = 3 if self.diffusion_solver is None else self.diffusion_solver.passes
+    pressure_passes = 3 if self.pressure_solver is None else self.pressure_solver.passes
 
-    self.h_velocity.swap()
-    self.v_velocity.swap()
-    diffuse_velocity(self.n, dt, self.viscosity, self.h_velocity, self.v_velocity)
+    # split velocity backtraces through both components for each of them,
+    # a vector field reads the velocity it backtraces through and interpolates once
+    advect_velocity_passes = 4 if self.velocity is None else 2
 
-    project(self.n, self.h_velocity.current, self.v_velocity.current, self.pressure, self.divergence)
+    def project_passes(iterations):
+      # divergence setup and the gradient subtraction around the solve
+      return 4 + pressure_passes * iterations + 5
 
-    self.h_velocity.swap()
-    self.v_velocity.swap()
+    # queued splats read nothing and add to the density and velocity cells under them
+    source_passes = 1
+    splat_bytes = 0
+    if self.source_queue is not None:
+      source_passes = 0
+      splat_bytes = 3 * self.source_queue.cells * np.dtype(to_numpy_type(self.pressure.dtype)).itemsize
 
-    advect_velocity(self.n, dt, self.h_velocity, self.v_velocity, self.h_velocity, self.v_velocity)	
+    return {
+      "apply_splats": splat_bytes,
+      "velocity_add_source": source_passes * 2 * 4 * field_bytes,
+      "diffuse_velocity": 2 * diffusion_passes * self.iterations.get("diffuse_velocity", 0) * field_bytes,
+      "project_diffused": project_passes(self.iterations.get("project_diffused", 0)) * field_bytes,
+      "advect_velocity": 2 * advect_velocity_passes * field_bytes,
+      "project_advected": project_passes(self.iterations.get("project_advected", 0)) * field_bytes,
+      "density_add_source": source_passes * 4 * field_bytes,
+      "diffuse_density": diffusion_passes * self.iterations.get("diffuse_density", 0) * field_bytes,
+      "advect_density": 4 * field_bytes,
+    }
 
-    project(self.n, self.h_velocity.current, self.v_velocity.current, self.pressure, self.divergence)
+  def __stage(self, name):
+    if self.profiler is None:
+      return NO_STAGE
+    return self.profiler.stage(name)
 
     
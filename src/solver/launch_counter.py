@@ -0,0 +1,18 @@
+import functools
+import taichi as ti
+
+# kernel launches issued through `kernel` since import
+launches = 0
+
+
+def kernel(func):
+  # `ti.kernel` that also counts every launch in `launches`
+  taichi_kernel = ti.kernel(func)
+
+  @functools.wraps(func)
+  def launch(*args):
+    global launches
+    launches += 1
+    return taichi_kernel(*args)
+
+  return launch
@@ -0,0 +1,133 @@
+import taichi as ti
+from .field_helpers import get_adjacent, bilinear_interpolate_nearest, new_field, norm, remove_mean, zero_sum, set_boundary, CONTAIN_WALLS
+from .launch_counter import kernel
+from .projection import develop_pressure_red_black
+
+
+@ti.data_oriented
+class MultigridSolver:
+  # Geometric multigrid for the pressure equation that `project` solves,
+  # 4p - (left + right + up + down) = divergence, with the same neumann
+  # boundary that `contain` applies. Level 0 works directly on the pressure
+  # and divergence fields handed to `solve`, every coarser level halves the
+  # grid (rounding up) until it is at most `coarsest_size` cells wide.
+  # The residual and coarse levels are stored in `dtype`.
+  def __init__(self, n, cycle="v", tolerance=1e-2, max_cycles=10, pre_sweeps=2, post_sweeps=2, coarsest_size=4, coarsest_sweeps=32, dtype=float, builder=None):
+    if cycle not in ("v", "w"):
+      raise ValueError(f"Unknown multigrid cycle '{cycle}', expected 'v' or 'w'")
+
+    self.n = n
+    self.cycle = cycle
+    self.tolerance = tolerance
+    self.max_cycles = max_cycles
+    self.pre_sweeps = pre_sweeps
+    self.post_sweeps = post_sweeps
+    self.coarsest_sweeps = coarsest_sweeps
+
+    # Estimated passes over a finest level field per cycle: 3 per smoothing 
+    # sweep, 3 for the residual, 3 for the transfers, with every coarser 
+    # level adding a quarter (v) or half (w) of the work of the one above
+    # it, plus 3 for the convergence check.
+    level_passes = 3 * (pre_sweeps + post_sweeps) + 6
+    self.passes = level_passes * (4 / 3 if cycle == "v" else 2) + 3
+
+    # cycles and relative residual of the last solve
+    self.cycles = 0
+    self.residual = 0.0
+
+    self.residual_field = new_field(dtype, (n + 2, n + 2), builder=builder)
+
+    # (size, pressure, rhs, residual) for every level below the finest
+    self.levels = []
+    m = n
+    while m > coarsest_size:
+      m = (m + 1) // 2
+      pressure = new_field(dtype, (m + 2, m + 2), builder=builder)
+      rhs = new_field(dtype, (m + 2, m + 2), builder=builder)
+      residual = new_field(dtype, (m + 2, m + 2), builder=builder)
+      self.levels.append((m, pressure, rhs, residual))
+
+  def solve(self, pressure, divergence):
+    levels = [(self.n, pressure, divergence, self.residual_field)] + self.levels
+    gamma = 1 if self.cycle == "v" else 2
+
+    # a pure neumann problem only has a solution for a zero mean right hand side
+    remove_mean(self.n, divergence)
+
+    rhs_norm = norm(self.n, divergence)
+    self.cycles = 0
+    self.residual = 0.0
+    if rhs_norm == 0:
+      return
+
+    self.residual = _residual(self.n, pressure, divergence, self.residual_field) / rhs_norm
+    while self.residual > self.tolerance and self.cycles < self.max_cycles:
+      _cycle(levels, 0, gamma, self.pre_sweeps, self.post_sweeps, self.coarsest_sweeps)
+      self.cycles += 1
+      self.residual = _residual(self.n, pressure, divergence, self.residual_field) / rhs_norm
+
+
+def _cycle(levels, level, gamma, pre_sweeps, post_sweeps, coarsest_sweeps):
+  m, pressure, rhs, residual = levels[level]
+
+  if level == len(levels) - 1:
+    _smooth(m, pressure, rhs, coarsest_sweeps)
+    return
+
+  _smooth(m, pressure, rhs, pre_sweeps)
+  _residual(m, pressure, rhs, residual)
+
+  m_coarse, pressure_coarse, rhs_coarse, _ = levels[level + 1]
+  _restrict(m, residual, m_coarse, rhs_coarse, pressure_coarse)
+
+  for _ in range(gamma):
+    _cycle(levels, level + 1, gamma, pre_sweeps, post_sweeps, coarsest_sweeps)
+
+  _prolongate(m, pressure, pressure_coarse)
+
+  _smooth(m, pressure, rhs, post_sweeps)
+
+
+def _smooth(m, pressure, rhs, sweeps):
+  for _ in range(sweeps):
+    develop_pressure_red_black(m, 1.0, 0, pressure, rhs, None)
+    develop_pressure_red_black(m, 1.0, 1, pressure, rhs, None)
+
+
+@kernel
+def _residual(m: int, pressure: ti.template(), rhs: ti.template(), residual: ti.template()) -> ti.f64:
+  total = zero_sum(residual)
+  for i, j in ti.ndrange((1, m + 1), (1, m + 1)):
+    left, right, up, down = get_adjacent(i, j, pressure)
+    r = rhs[i, j] - (4 * pressure[i, j] - left - right - up - down)
+    residual[i, j] = r
+    total += r * r
+  return ti.sqrt(total)
+
+
+@kernel
+def _restrict(m: int, residual: ti.template(), m_coarse: int, rhs_coarse: ti.template(), pressure_coarse: ti.template()):
+  # the coarse operator spans twice the cell width,
+  # so summing the children keeps the equation scaled
+  for I, J in ti.ndrange((1, m_coarse + 1), (1, m_coarse + 1)):
+    total = zero_sum(rhs_coarse)
+    for di, dj in ti.static(ti.ndrange(2, 2)):
+      i = 2 * I - 1 + di
+      j = 2 * J - 1 + dj
+      if i <= m and j <= m:
+        total += residual[i, j]
+
+    rhs_coarse[I, J] = total
+    pressure_coarse[I, J] = 0
+    set_boundary(m_coarse, pressure_coarse, I, J, 0.0, CONTAIN_WALLS)
+
+
+@kernel
+def _prolongate(m: int, pressure: ti.template(), pressure_coarse: ti.template()):
+  for i, j in ti.ndrange((1, m + 1), (1, m + 1)):
+    # centre of fine cell (i, j) in coarse cell coordinates
+    x = (i + 0.5) * 0.5
+    y = (j + 0.5) * 0.5
+    value = pressure[i, j] + bilinear_interpolate_nearest(x, y, pressure_coarse)
+    pressure[i, j] = value
+    set_boundary(m, pressure, i, j, value, CONTAIN_WALLS)
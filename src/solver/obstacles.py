@@ -0,0 +1,161 @@
+import numpy as np
+import taichi as ti
+from .field_helpers import mirror, CONTAIN_WALLS
+from .launch_counter import kernel
+
+# bits of the sides of a boundary cell that face fluid
+LEFT, RIGHT, DOWN, UP = 1, 2, 4, 8
+
+
+@ti.data_oriented
+class Obstacles:
+  # Solid cells inside the box, held as a mask on the host. `update`
+  # turns it into the list of solid cells with a fluid neighbour, each
+  # with the sides it faces fluid on, so `apply` costs in proportion to
+  # the length of the obstacle outlines instead of the grid area. The
+  # stencil kernels stay free of branches, they keep updating solid cells
+  # and `apply` overwrites the boundary ones after every pass. It also
+  # zeroes the ring of solid cells just inside them, so little seeps
+  # further in for backtraces that cross a boundary to pick up.
+  #
+  # A boundary cell takes the mean of its fluid neighbours, mirrored with
+  # the signs of the outer walls along the axis each one lies on. Scalars
+  # get a zero normal gradient and velocities lose their normal component
+  # and slip along the surface, with `no_slip` they are negated on every
+  # side so the velocity vanishes at the surface.
+  def __init__(self, n, no_slip=False):
+    self.n = n
+    self.no_slip = no_slip
+
+    # mask[i, j] marks field cell (i, j) solid, only interior cells count
+    self.mask = np.zeros((n + 2, n + 2), dtype=bool)
+    self.changed = True
+
+    # (i, j, sides) of every boundary cell, (i, j) of the solid cells
+    # next to them and of every solid cell
+    self.boundary = None
+    self.inner = None
+    self.solid = None
+
+  def set_mask(self, mask: np.ndarray):
+    # `mask` is n x n, mask[x, y] is interior cell (x + 1, y + 1)
+    if mask.shape != (self.n, self.n):
+      raise ValueError(f"Obstacle mask of shape {mask.shape} does not match n={self.n}")
+    self.mask[1:-1, 1:-1] = mask
+    self.changed = True
+
+  def add_circle(self, x: int, y: int, radius: int):
+    i, j = np.ogrid[:self.n + 2, :self.n + 2]
+    self.mask |= (i - x) ** 2 + (j - y) ** 2 <= radius * radius
+    self.__clip()
+
+  def add_rectangle(self, x0: int, y0: int, x1: int, y1: int):
+    self.mask[x0:x1 + 1, y0:y1 + 1] = True
+    self.__clip()
+
+  def resized(self, n: int):
+    # the same obstacles on an n x n grid, each cell takes the one nearest its centre
+    obstacles = Obstacles(n, self.no_slip)
+    source = (np.arange(n) + 0.5) * self.n / n
+    index = np.minimum(source.astype(int), self.n - 1)
+    obstacles.set_mask(self.mask[1:-1, 1:-1][np.ix_(index, index)])
+    return obstacles
+
+  def clear(self):
+    self.mask[:] = False
+    self.changed = True
+
+  def update(self) -> bool:
+    # rebuild the cell lists once the mask changed, returns whether it did
+    if not self.changed:
+      return False
+    self.changed = False
+
+    solid = self.mask
+    fluid = np.zeros_like(solid)
+    fluid[1:-1, 1:-1] = ~solid[1:-1, 1:-1]
+
+    sides = np.zeros(solid.shape, dtype=np.int32)
+    sides[1:, :] |= LEFT * fluid[:-1, :]
+    sides[:-1, :] |= RIGHT * fluid[1:, :]
+    sides[:, 1:] |= DOWN * fluid[:, :-1]
+    sides[:, :-1] |= UP * fluid[:, 1:]
+    sides[~solid] = 0
+
+    boundary = sides != 0
+    inner = np.zeros_like(solid)
+    inner[1:, :] |= boundary[:-1, :]
+    inner[:-1, :] |= boundary[1:, :]
+    inner[:, 1:] |= boundary[:, :-1]
+    inner[:, :-1] |= boundary[:, 1:]
+    inner &= solid & ~boundary
+
+    i, j = np.nonzero(boundary)
+    self.boundary = upload(np.stack([i, j, sides[i, j]], axis=1))
+    self.inner = upload(np.stack(np.nonzero(inner), axis=1))
+    self.solid = upload(np.stack(np.nonzero(solid), axis=1))
+    return True
+
+  def apply(self, walls, *fields):
+    # set the boundary cells of `fields` after a pass wrote them, `walls` as for `set_boundary`
+    if walls is None or self.boundary is None:
+      return
+    if self.no_slip and walls != CONTAIN_WALLS:
+      walls = no_slip_walls(walls)
+    _apply_boundary(self.boundary, walls, fields)
+    if self.inner is not None:
+      _zero_cells(self.inner, fields)
+
+  def zero(self, *fields):
+    # clear every solid cell, so nothing starts out inside an obstacle
+    if self.solid is not None:
+      _zero_cells(self.solid, fields)
+
+  def __clip(self):
+    # the outer walls are the box's own, obstacles only cover interior cells
+    self.mask[0, :] = self.mask[-1, :] = self.mask[:, 0] = self.mask[:, -1] = False
+    self.changed = True
+
+
+def no_slip_walls(walls):
+  # every sign of a velocity wall negated, a vector wall per component
+  return tuple(no_slip_walls(sign) if isinstance(sign, tuple) else -1 for sign in walls)
+
+
+def upload(cells: np.ndarray):
+  if len(cells) == 0:
+    return None
+  device_cells = ti.ndarray(dtype=ti.i32, shape=cells.shape)
+  device_cells.from_numpy(np.ascontiguousarray(cells, dtype=np.int32))
+  return device_cells
+
+
+@kernel
+def _apply_boundary(boundary: ti.types.ndarray(dtype=ti.i32, ndim=2), walls: ti.template(), fields: ti.template()):
+  for b in range(boundary.shape[0]):
+    i = boundary[b, 0]
+    j = boundary[b, 1]
+    sides = boundary[b, 2]
+    for field in ti.static(fields):
+      total = 0.0 * field[i, j]
+      count = 0
+      if sides & LEFT:
+        total += mirror(walls[0], 1.0 * field[i - 1, j])
+        count += 1
+      if sides & RIGHT:
+        total += mirror(walls[0], 1.0 * field[i + 1, j])
+        count += 1
+      if sides & DOWN:
+        total += mirror(walls[1], 1.0 * field[i, j - 1])
+        count += 1
+      if sides & UP:
+        total += mirror(walls[1], 1.0 * field[i, j + 1])
+        count += 1
+      field[i, j] = total / count
+
+
+@kernel
+def _zero_cells(cells: ti.types.ndarray(dtype=ti.i32, ndim=2), fields: ti.template()):
+  for c in range(cells.shape[0]):
+    for field in ti.static(fields):
+      field[cells[c, 0], cells[c, 1]] = 0
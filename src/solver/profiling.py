@@ -0,0 +1,110 @@
+import json
+import time
+from collections import deque
+import numpy as np
+import taichi as ti
+
+
+class StageProfiler:
+  # Rolling per stage timings for `FluidField.step`. Every stage is
+  # bracketed by `ti.sync` so its wall time covers the kernels it launched,
+  # with `kernel_timings` (needs `ti.init(kernel_profiler=True)`) the device
+  # time reported by the taichi kernel profiler is kept as well. Only the
+  # last `window` samples of every stage are kept.
+  def __init__(self, window=300, kernel_timings=False):
+    self.window = window
+    self.kernel_timings = kernel_timings
+
+    self.wall_times = {}
+    self.kernel_times = {}
+    self.iterations = {}
+    self.bytes_touched = {}
+
+    self.__step_start = 0.0
+    self.__step_kernel_time = 0.0
+
+  def stage(self, name):
+    return _Stage(self, name)
+
+  def begin_step(self):
+    ti.sync()
+    self.__step_kernel_time = 0.0
+    self.__step_start = time.perf_counter()
+
+  def end_step(self, iterations, bytes_touched):
+    ti.sync()
+    self.__record(self.wall_times, "step", time.perf_counter() - self.__step_start)
+    if self.kernel_timings:
+      self.__record(self.kernel_times, "step", self.__step_kernel_time)
+
+    for name, count in iterations.items():
+      self.__record(self.iterations, name, count)
+    for name, count in bytes_touched.items():
+      self.__record(self.bytes_touched, name, count)
+    self.__record(self.bytes_touched, "step", sum(bytes_touched.values()))
+
+  def record_stage(self, name, wall_time, kernel_time=None):
+    self.__record(self.wall_times, name, wall_time)
+    if kernel_time is not None:
+      self.__record(self.kernel_times, name, kernel_time)
+      self.__step_kernel_time += kernel_time
+
+  def statistics(self):
+    statistics = {}
+    for name, samples in self.wall_times.items():
+      wall_times = np.array(samples)
+      stage = {
+        "samples": len(wall_times),
+        "mean": float(wall_times.mean()),
+        "p50": float(np.percentile(wall_times, 50)),
+        "p99": float(np.percentile(wall_times, 99)),
+        "max": float(wall_times.max()),
+      }
+
+      if name in self.kernel_times:
+        kernel_times = np.array(self.kernel_times[name])
+        stage["kernel_mean"] = float(kernel_times.mean())
+        stage["kernel_p99"] = float(np.percentile(kernel_times, 99))
+
+      if name in self.iterations:
+        stage["iterations_mean"] = float(np.mean(self.iterations[name]))
+        stage["iterations_max"] = int(np.max(self.iterations[name]))
+
+      if name in self.bytes_touched:
+        bytes_touched = float(np.mean(self.bytes_touched[name]))
+        stage["bytes_mean"] = bytes_touched
+        stage["bandwidth_mean"] = bytes_touched / stage["mean"] if stage["mean"] > 0 else 0.0
+
+      statistics[name] = stage
+    return statistics
+
+  def dump(self, path):
+    with open(path, "w") as file:
+      json.dump(self.statistics(), file, indent=2)
+
+  def clear(self):
+    for samples in (self.wall_times, self.kernel_times, self.iterations, self.bytes_touched):
+      samples.clear()
+
+  def __record(self, samples, name, value):
+    if name not in samples:
+      samples[name] = deque(maxlen=self.window)
+    samples[name].append(value)
+
+
+class _Stage:
+  def __init__(self, profiler, name):
+    self.profiler = profiler
+    self.name = name
+
+  def __enter__(self):
+    ti.sync()
+    if self.profiler.kernel_timings:
+      ti.profiler.clear_kernel_profiler_info()
+    self.start = time.perf_counter()
+
+  def __exit__(self, *_):
+    ti.sync()
+    wall_time = time.perf_counter() - self.start
+    kernel_time = ti.profiler.get_kernel_profiler_total_time() if self.profiler.kernel_timings else None
+    self.profiler.record_stage(self.name, wall_time, kernel_time)
@@ -1,49 +1,186 @@
 import taichi as ti
-from .field_helpers import get_adjacent, contain, nullify_boundary_flow
+from .field_helpers import get_adjacent, cell_count, cell_index, red_black_count, red_black_index, exchange, enforce, reduce_norm, norm, remove_mean, zero_sum, set_boundary, index, CONTAIN_WALLS, H_VELOCITY_WALLS, V_VELOCITY_WALLS, VELOCITY_WALLS
+from .launch_counter import kernel
+from .convergence import iterate
 
 def project(n: int, 
     h_velocity: ti.template(), 
     v_velocity: ti.template(), 
     pressure: ti.template(), 
-    divergence: ti.template()
+    divergence: ti.template(),
+    pressure_solver=None,
+    convergence=None,
+    smoother=None,
+    tiles=None,
+    obstacles=None
   ):
   h = 1.0 / n
   
-  __init_divergence_and_pressure(n, h, h_velocity, v_velocity, pressure, divergence)
-  contain(n, divergence)
-  contain(n, pressure)
+  __init_divergence_and_pressure(n, h, h_velocity, v_velocity, pressure, divergence, tiles)
+  exchange(tiles, pressure)
 
-  for _ in range(20):
-    __develop_pressure(n, pressure, divergence)
-    contain(n, pressure)
+  iterations = __solve_pressure(n, pressure, divergence, pressure_solver, convergence, smoother, tiles, obstacles)
 
-  __project_kernel(n, h, h_velocity, v_velocity, pressure)
-  nullify_boundary_flow(n, h_velocity, v_velocity)
+  __project_kernel(n, h, h_velocity, v_velocity, pressure, tiles)
+  exchange(tiles, h_velocity, v_velocity)
+  enforce(obstacles, H_VELOCITY_WALLS, h_velocity)
+  enforce(obstacles, V_VELOCITY_WALLS, v_velocity)
 
+  return iterations
 
-@ti.kernel
-def __init_divergence_and_pressure(n: int, h: float, h_velocity: ti.template(), v_velocity: ti.template(), pressure: ti.template(), divergence: ti.template()):
-  for i, j in ti.ndrange((1, n + 1), (1, n + 1)):
-    left, right, _, _ = get_adjacent(i, j, h_velocity)
-    _, _, up, down = get_adjacent(i, j, v_velocity)
 
-    divergence[i, j] = -0.5 * h * (right - left + up - down)
+def project_vector(n: int, 
+    velocity: ti.template(), 
+    pressure: ti.template(), 
+    divergence: ti.template(),
+    pressure_solver=None,
+    convergence=None,
+    smoother=None,
+    tiles=None,
+    obstacles=None
+  ):
+  h = 1.0 / n
+
+  __init_divergence_and_pressure_vector(n, h, velocity, pressure, divergence, tiles)
+  exchange(tiles, pressure)
+
+  iterations = __solve_pressure(n, pressure, divergence, pressure_solver, convergence, smoother, tiles, obstacles)
+
+  __project_vector_kernel(n, h, velocity, pressure, tiles)
+  exchange(tiles, velocity)
+  enforce(obstacles, VELOCITY_WALLS, velocity)
+
+  return iterations
+
+
+def __solve_pressure(n, pressure, divergence, pressure_solver, convergence, smoother, tiles, obstacles):
+  if pressure_solver is None:
+    if convergence is not None:
+      # a pure neumann problem only converges for a zero mean divergence
+      remove_mean(n, divergence, tiles)
+
+    def sweep():
+      if smoother is None:
+        __develop_pressure(n, pressure, divergence, tiles)
+        exchange(tiles, pressure)
+        enforce(obstacles, CONTAIN_WALLS, pressure)
+      else:
+        develop_pressure_red_black(n, smoother.omega, 0, pressure, divergence, tiles)
+        exchange(tiles, pressure)
+        enforce(obstacles, CONTAIN_WALLS, pressure)
+        develop_pressure_red_black(n, smoother.omega, 1, pressure, divergence, tiles)
+        exchange(tiles, pressure)
+        enforce(obstacles, CONTAIN_WALLS, pressure)
+
+    def residual_norm():
+      return reduce_norm(tiles, __residual_norm(n, pressure, divergence, tiles))
+
+    def rhs_norm():
+      return norm(n, divergence, tiles)
+
+    iterations = iterate(convergence, sweep, residual_norm, rhs_norm)
+  else:
+    pressure_solver.solve(pressure, divergence)
+    iterations = pressure_solver.cycles
+
+  return iterations
+
+
+@kernel
+def __init_divergence_and_pressure(n: int, h: float, h_velocity: ti.template(), v_velocity: ti.template(), pressure: ti.template(), divergence: ti.template(), tiles: ti.template()):
+  for c in range(cell_count(n, tiles)):
+    i, j = cell_index(n, tiles, c)
+    init_divergence_and_pressure_cell(n, h, h_velocity, v_velocity, pressure, divergence, i, j)
+
+
+@ti.func
+def init_divergence_and_pressure_cell(n, h, h_velocity, v_velocity, pressure, divergence, i, j, member: ti.template() = None):
+  left, right, _, _ = get_adjacent(i, j, h_velocity, member)
+  _, _, up, down = get_adjacent(i, j, v_velocity, member)
+
+  d = -0.5 * h * (right - left + up - down)
+  divergence[index(i, j, member)] = d
+  pressure[index(i, j, member)] = 0
+  set_boundary(n, divergence, i, j, d, CONTAIN_WALLS, member)
+  set_boundary(n, pressure, i, j, 0.0, CONTAIN_WALLS, member)
+
+
+@kernel
+def __init_divergence_and_pressure_vector(n: int, h: float, velocity: ti.template(), pressure: ti.template(), divergence: ti.template(), tiles: ti.template()):
+  for c in range(cell_count(n, tiles)):
+    i, j = cell_index(n, tiles, c)
+    left, right, up, down = get_adjacent(i, j, velocity)
+
+    d = -0.5 * h * (right[0] - left[0] + up[1] - down[1])
+    divergence[i, j] = d
     pressure[i, j] = 0
+    set_boundary(n, divergence, i, j, d, CONTAIN_WALLS)
+    set_boundary(n, pressure, i, j, 0.0, CONTAIN_WALLS)
 
 
-@ti.kernel
-def __develop_pressure(n: int, pressure: ti.template(), divergence: ti.template()):
-  for i, j in ti.ndrange((1, n + 1), (1, n + 1)):
-    left, right, up, down = get_adjacent(i, j, pressure)
-    pressure[i, j] = (divergence[i, j] + left + right + up + down) / 4
+@kernel
+def __develop_pressure(n: int, pressure: ti.template(), divergence: ti.template(), tiles: ti.template()):
+  for c in range(cell_count(n, tiles)):
+    i, j = cell_index(n, tiles, c)
+    develop_pressure_cell(n, pressure, divergence, i, j)
+
+
+@ti.func
+def develop_pressure_cell(n, pressure, divergence, i, j, member: ti.template() = None):
+  left, right, up, down = get_adjacent(i, j, pressure, member)
+  value = (divergence[index(i, j, member)] + left + right + up + down) / 4
+  pressure[index(i, j, member)] = value
+  set_boundary(n, pressure, i, j, value, CONTAIN_WALLS, member)
+
+
+@kernel
+def develop_pressure_red_black(n: int, omega: float, parity: int, pressure: ti.template(), divergence: ti.template(), tiles: ti.template()):
+  for c in range(red_black_count(n, tiles)):
+    i, j, colour = red_black_index(n, tiles, c, parity)
+    if colour:
+      left, right, up, down = get_adjacent(i, j, pressure)
+      gauss_seidel = (divergence[i, j] + left + right + up + down) / 4
+      value = pressure[i, j] + omega * (gauss_seidel - pressure[i, j])
+      pressure[i, j] = value
+      set_boundary(n, pressure, i, j, value, CONTAIN_WALLS)
 
 
-@ti.kernel
-def __project_kernel(n: int, h: float, h_velocity: ti.template(), v_velocity: ti.template(), pressure: ti.template()):
-  for i, j in ti.ndrange((1, n + 1), (1, n + 1)):
+@kernel
+def __residual_norm(n: int, pressure: ti.template(), divergence: ti.template(), tiles: ti.template()) -> ti.f64:
+  total = zero_sum(pressure)
+  for c in range(cell_count(n, tiles)):
+    i, j = cell_index(n, tiles, c)
     left, right, up, down = get_adjacent(i, j, pressure)
+    r = divergence[i, j] - (4 * pressure[i, j] - left - right - up - down)
+    total += r * r
+  return ti.sqrt(total)
 
-    h_velocity[i, j] -= 0.5 * (right - left) / h
-    v_velocity[i, j] -= 0.5 * (up - down) / h
-  
 
+@kernel
+def __project_kernel(n: int, h: float, h_velocity: ti.template(), v_velocity: ti.template(), pressure: ti.template(), tiles: ti.template()):
+  for c in range(cell_count(n, tiles)):
+    i, j = cell_index(n, tiles, c)
+    project_cell(n, h, h_velocity, v_velocity, pressure, i, j)
+
+
+@ti.func
+def project_cell(n, h, h_velocity, v_velocity, pressure, i, j, member: ti.template() = None):
+  left, right, up, down = get_adjacent(i, j, pressure, member)
+
+  h_value = h_velocity[index(i, j, member)] - 0.5 * (right - left) / h
+  v_value = v_velocity[index(i, j, member)] - 0.5 * (up - down) / h
+  h_velocity[index(i, j, member)] = h_value
+  v_velocity[index(i, j, member)] = v_value
+  set_boundary(n, h_velocity, i, j, h_value, H_VELOCITY_WALLS, member)
+  set_boundary(n, v_velocity, i, j, v_value, V_VELOCITY_WALLS, member)
+
+
+@kernel
+def __project_vector_kernel(n: int, h: float, velocity: ti.template(), pressure: ti.template(), tiles: ti.template()):
+  for c in range(cell_count(n, tiles)):
+    i, j = cell_index(n, tiles, c)
+    left, right, up, down = get_adjacent(i, j, pressure)
+
+    value = velocity[i, j] - 0.5 * ti.Vector([right - left, up - down]) / h
+    velocity[i, j] = value
+    set_boundary(n, velocity, i, j, value, VELOCITY_WALLS)
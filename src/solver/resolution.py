@@ -0,0 +1,159 @@
+import math
+import time
+import taichi as ti
+from .active_tiles import ActiveTiles
+from .field_helpers import apply_walls, bilinear_interpolate_nearest, CONTAIN_WALLS, H_VELOCITY_WALLS, V_VELOCITY_WALLS, VELOCITY_WALLS
+from .launch_counter import kernel
+
+# settings and counters a resized field keeps
+CARRIED_ATTRIBUTES = (
+  "viscosity", "diffusion_rate", "convergence", "diffusion_smoother", "pressure_smoother",
+  "cfl", "max_substeps", "source_queue", "profiler", "checkpointer",
+  "step_index", "frame_index", "time_step",
+)
+
+
+class ResolutionScaler:
+  # Keeps the time `advance` takes near `frame_budget` seconds by resizing
+  # the grid between frames. `create_fluid(n, builder)` builds a field
+  # with all of its fields in `builder`, so the tree of a replaced field
+  # is destroyed and its memory released. Density and velocity carry over
+  # by bilinear resampling, settings and counters are copied, obstacles
+  # and active tiles are rebuilt for the new size. Attributes the scaler
+  # does not have itself are read from and set on the current field.
+  #
+  # Step times are smoothed over frames. Once the average stays above the
+  # budget, or below `grow_below` of it, for `patience` frames, n moves to
+  # where the cost, taken to grow with n^2, hits `target` of the budget.
+  # Resized grids are multiples of `granularity` within [min_n, max_n], or
+  # max_n itself, the starting n is only clamped to that range. The
+  # frames right after a resize, which compile kernels, are not measured.
+  def __init__(self, create_fluid, n, frame_budget, min_n=64, max_n=1024, granularity=16, patience=10, target=0.8, grow_below=0.5, smoothing=0.2):
+    self.create_fluid = create_fluid
+    self.frame_budget = frame_budget
+    self.min_n = min_n
+    self.max_n = max_n
+    self.granularity = granularity
+    self.patience = patience
+    self.target = target
+    self.grow_below = grow_below
+    self.smoothing = smoothing
+
+    # smoothed seconds per frame, and frames it was over or under the budget in a row
+    self.frame_time = None
+    self.over = 0
+    self.under = 0
+    self.settle = 2
+
+    # (frame index, old n, new n) of every resize
+    self.resizes = []
+
+    builder = ti.FieldsBuilder()
+    fluid = create_fluid(min(max(n, min_n), max_n), builder)
+    self.tree = builder.finalize()
+    self.fluid = fluid
+
+  def __getattr__(self, name):
+    # stands in for the current field, a field held across a resize is already released
+    if name == "fluid":
+      raise AttributeError(name)
+    return getattr(self.fluid, name)
+
+  def __setattr__(self, name, value):
+    # once there is a field, everything but the scaler's own attributes is set on it
+    if "fluid" not in self.__dict__ or name in self.__dict__:
+      object.__setattr__(self, name, value)
+    else:
+      setattr(self.fluid, name, value)
+
+  def advance(self, frame_dt: float) -> bool:
+    # advance the field one frame, returns whether the grid was resized after it
+    start = time.perf_counter()
+    self.fluid.advance(frame_dt)
+    ti.sync()
+    elapsed = time.perf_counter() - start
+
+    if self.settle > 0:
+      self.settle -= 1
+      return False
+
+    if self.frame_time is None:
+      self.frame_time = elapsed
+    self.frame_time += self.smoothing * (elapsed - self.frame_time)
+
+    self.over = self.over + 1 if self.frame_time > self.frame_budget else 0
+    self.under = self.under + 1 if self.frame_time < self.grow_below * self.frame_budget else 0
+    if self.over < self.patience and self.under < self.patience:
+      return False
+
+    n = self.__round(self.n * math.sqrt(self.target * self.frame_budget / self.frame_time))
+    self.over = 0
+    self.under = 0
+    if n == self.n:
+      return False
+    self.resize(n)
+    return True
+
+  def resize(self, n: int):
+    old_fluid = self.fluid
+    old_tree = self.tree
+
+    builder = ti.FieldsBuilder()
+    fluid = self.create_fluid(n, builder)
+    tiles = old_fluid.active_tiles
+    if tiles is not None and fluid.active_tiles is None:
+      # the old tile size where it still divides n
+      tile_size = tiles.size if n % tiles.size == 0 else None
+      fluid.active_tiles = ActiveTiles(n, tile_size, tiles.threshold, tiles.halo, builder)
+    self.tree = builder.finalize()
+
+    for name in CARRIED_ATTRIBUTES:
+      setattr(fluid, name, getattr(old_fluid, name))
+    if old_fluid.obstacles is not None:
+      fluid.obstacles = old_fluid.obstacles.resized(n)
+    resample_fluid(old_fluid, fluid)
+
+    self.resizes.append((old_fluid.frame_index, old_fluid.n, n))
+    self.fluid = fluid
+    self.frame_time = None
+    self.settle = 2
+    old_tree.destroy()
+
+  def __round(self, n) -> int:
+    if n > self.max_n - self.granularity / 2:
+      return self.max_n
+    n = int(round(n / self.granularity)) * self.granularity
+    return min(max(n, self.min_n), self.max_n)
+
+
+def resample_fluid(source, target):
+  # density and velocity of `source` interpolated onto the grid of `target`,
+  # velocities are in domain lengths per time and keep their values
+  _resample(source.n, source.density.current, target.n, target.density.current)
+  apply_walls(target.n, target.density.current, CONTAIN_WALLS)
+
+  if target.velocity is not None:
+    if source.velocity is None:
+      raise ValueError("Can not resample a split velocity into a vector one")
+    _resample(source.n, source.velocity.current, target.n, target.velocity.current)
+    apply_walls(target.n, target.velocity.current, VELOCITY_WALLS)
+  else:
+    if source.velocity is not None:
+      raise ValueError("Can not resample a vector velocity into a split one")
+    _resample(source.n, source.h_velocity.current, target.n, target.h_velocity.current)
+    _resample(source.n, source.v_velocity.current, target.n, target.v_velocity.current)
+    apply_walls(target.n, target.h_velocity.current, H_VELOCITY_WALLS)
+    apply_walls(target.n, target.v_velocity.current, V_VELOCITY_WALLS)
+
+  if target.active_tiles is not None:
+    target.active_tiles.rescan = True
+
+
+@kernel
+def _resample(source_n: int, source: ti.template(), target_n: int, target: ti.template()):
+  # cell centres line up, interior cell i of n sits at (i - 0.5) / n of the domain
+  scale = source_n / target_n
+  for i, j in ti.ndrange((1, target_n + 1), (1, target_n + 1)):
+    x = ti.math.clamp((i - 0.5) * scale + 0.5, 0.5, source_n + 0.5)
+    y = ti.math.clamp((j - 0.5) * scale + 0.5, 0.5, source_n + 0.5)
+    target[i, j] = bilinear_interpolate_nearest(x, y, source)
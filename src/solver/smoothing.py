@@ -0,0 +1,10 @@
+class RedBlackSOR:
+  # Relax the cells with an even i + j first and the odd ones second. 
+  # Each half sweep only reads neighbours of the other colour, so it is 
+  # race free and deterministic. `omega` over-relaxes every update,
+  # 1 is plain gauss-seidel.
+  def __init__(self, omega=1.0):
+    if not 0 < omega < 2:
+      raise ValueError(f"SOR factor must be in (0, 2), got {omega}")
+
+    self.omega = omega
@@ -0,0 +1,73 @@
+import numpy as np
+import taichi as ti
+from taichi.lang.util import to_numpy_type
+from .field_helpers import remove_mean
+
+
+class SpectralSolver:
+  # Direct solve of the pressure equation `project` iterates on,
+  # 4p - (left + right + up + down) = divergence, with the neumann
+  # boundary of `contain`. Cosine transforms (DCT-II) diagonalize that
+  # operator, so one forward transform, a division by its eigenvalues
+  # and an inverse transform give the exact solution in O(n^2 log n),
+  # whatever the divergence. Only holds for the plain box, obstacles
+  # change the operator. The transforms run on host copies of the
+  # fields through numpy's fft, in f64 for a `dtype` of ti.f64 and in
+  # f32 otherwise.
+  def __init__(self, n, dtype=float):
+    self.n = n
+    self.dtype = np.float64 if dtype == ti.f64 else np.float32
+
+    # one read of the divergence and one write of the pressure
+    self.passes = 2
+
+    # a direct solve is always one cycle
+    self.cycles = 1
+
+    # eigenvalues of the 1d neumann second difference, 2 - 2cos(pi k / n),
+    # summed over both axes, the constant mode k = l = 0 stays at zero
+    k = np.arange(n)
+    eigenvalues = 2 - 2 * np.cos(np.pi * k / n)
+    denominator = eigenvalues[:, None] + eigenvalues[None, :]
+    denominator[0, 0] = 1
+    self.inverse = (1 / denominator).astype(self.dtype)
+    self.inverse[0, 0] = 0
+
+    # twiddle factors of the dct computed through an fft of length n
+    self.twiddle = np.exp(-0.5j * np.pi * k / n).astype(np.complex64 if self.dtype == np.float32 else np.complex128)
+
+  def solve(self, pressure, divergence):
+    # a pure neumann problem only has a solution for a zero mean right hand side
+    remove_mean(self.n, divergence)
+
+    n = self.n
+    rhs = divergence.to_numpy()[1:n + 1, 1:n + 1].astype(self.dtype)
+    solution = self.__idct(self.__idct(self.__dct(self.__dct(rhs, 0), 1) * self.inverse, 1), 0)
+
+    # edge padding is what `contain` writes into the boundary, corners included
+    full = np.pad(solution, 1, mode="edge")
+    pressure.from_numpy(full.astype(to_numpy_type(pressure.dtype), copy=False))
+
+  def __dct(self, x, axis):
+    # unnormalized DCT-II along `axis`, sum_m x_m cos(pi k (2m + 1) / 2n),
+    # by reordering into one real fft, the upper half of its spectrum
+    # mirrors the lower one
+    x = np.moveaxis(x, axis, 0)
+    reordered = np.concatenate([x[::2], x[1::2][::-1]])
+    half = np.fft.rfft(reordered, axis=0)
+    spectrum = np.concatenate([half, np.conj(half[1:self.n - self.n // 2][::-1])])
+    result = (self.twiddle[:, None] * spectrum).real
+    return np.moveaxis(result, 0, axis)
+
+  def __idct(self, y, axis):
+    # inverse of `__dct` along `axis`, the spectrum it rebuilds is hermitian so a real inverse fft does
+    y = np.moveaxis(y, axis, 0)
+    count = self.n // 2 + 1
+    shifted = np.concatenate([np.zeros_like(y[:1]), y[:0:-1]])[:count]
+    spectrum = np.conj(self.twiddle[:count])[:, None] * (y[:count] - 1j * shifted)
+    reordered = np.fft.irfft(spectrum, self.n, axis=0)
+    result = np.empty_like(reordered)
+    half = (self.n + 1) // 2
+    result[::2] = reordered[:half]
+    result[1::2] = reordered[half:][::-1]
+    return np.moveaxis(result, 0, axis)
@@ -0,0 +1,77 @@
+import math
+import numpy as np
+import taichi as ti
+from .field_helpers import is_vector
+from .launch_counter import kernel
+
+# columns of a queued splat
+SPLAT_X, SPLAT_Y, SPLAT_RADIUS, SPLAT_DENSITY, SPLAT_H_FORCE, SPLAT_V_FORCE = range(6)
+
+
+class SplatQueue:
+  # Collects density and force splats on the host and adds them to the
+  # current fields in one kernel that only visits the cells under them,
+  # scaled by dt like `add_source` does with the dense source buffers.
+  # A step costs in proportion to the splats queued since the last one,
+  # the queue is emptied once they are applied.
+  def __init__(self):
+    self.splats = []
+
+    # cells the last `apply` visited
+    self.cells = 0
+
+  def __len__(self):
+    return len(self.splats)
+
+  def add(self, x: int, y: int, radius: int, density: float = 0, h_force: float = 0, v_force: float = 0):
+    self.splats.append((x, y, radius, density, h_force, v_force))
+
+  def add_stroke(self, x0: int, y0: int, x1: int, y1: int, radius: int, density: float = 0, h_force: float = 0, v_force: float = 0):
+    # splats every half radius from (x0, y0) to (x1, y1), sharing the
+    # amounts of one splat so a fast stroke injects no more than a still one
+    points = stroke_points(x0, y0, x1, y1, radius)
+    for x, y in points:
+      self.add(x, y, radius, density / len(points), h_force / len(points), v_force / len(points))
+
+  def apply(self, n: int, dt: float, density, velocity):
+    # `velocity` is a tuple of the vector field or the h and v fields
+    if not self.splats:
+      self.cells = 0
+      return
+
+    splats = np.array(self.splats, dtype=np.float32)
+    radius = int(splats[:, SPLAT_RADIUS].max())
+    _apply_splats(n, dt, radius, splats, density, tuple(velocity))
+    self.cells = len(splats) * (2 * radius + 1) ** 2
+    self.clear()
+
+  def clear(self):
+    self.splats = []
+
+
+def stroke_points(x0: int, y0: int, x1: int, y1: int, radius: int) -> list:
+  steps = max(1, math.ceil(2 * math.hypot(x1 - x0, y1 - y0) / max(radius, 1)))
+  return [(round(x0 + (x1 - x0) * k / steps), round(y0 + (y1 - y0) * k / steps)) for k in range(1, steps + 1)]
+
+
+@kernel
+def _apply_splats(n: int, dt: float, radius: int, splats: ti.types.ndarray(), density: ti.template(), velocity: ti.template()):
+  # every splat covers the square of the largest radius, cells outside its own circle are skipped
+  side = 2 * radius + 1
+  for s, k in ti.ndrange(splats.shape[0], side * side):
+    i = k // side - radius
+    j = k % side - radius
+    x = int(splats[s, SPLAT_X]) + i
+    y = int(splats[s, SPLAT_Y]) + j
+    splat_radius = int(splats[s, SPLAT_RADIUS])
+    if 0 <= x < n and 0 <= y < n and i*i + j*j <= splat_radius*splat_radius:
+      if splats[s, SPLAT_DENSITY] != 0:
+        density[x, y] += dt * splats[s, SPLAT_DENSITY]
+
+      force = ti.Vector([splats[s, SPLAT_H_FORCE], splats[s, SPLAT_V_FORCE]])
+      if (force != 0).any():
+        if ti.static(is_vector(velocity[0])):
+          velocity[0][x, y] += dt * force
+        else:
+          velocity[0][x, y] += dt * force[0]
+          velocity[1][x, y] += dt * force[1]
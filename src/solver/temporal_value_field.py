@@ -1,26 +1,17 @@
 import taichi as ti
+from .field_helpers import new_field
 
-@ti.data_oriented
 class TemporalValueField:
-  def __init__(self, shape, dtype) -> None:
-    self.current = ti.field(dtype=dtype, shape=shape)
-    self.previous = ti.field(dtype=dtype, shape=shape)
+  # Swapping only flips which buffer counts as current/previous.
+  # Kernels must be handed `current` and `previous` as template 
+  # arguments on every call, reading them through this object inside 
+  # a kernel would bake in whichever buffer was current at compile time.
+  # With `components` both buffers are vector fields stored in `layout`,
+  # `offset` is the index of their first element and a `builder` places
+  # them in its tree.
+  def __init__(self, shape, dtype, components=None, layout=ti.Layout.AOS, offset=None, builder=None) -> None:
+    self.current = new_field(dtype, shape, components, layout, offset, builder)
+    self.previous = new_field(dtype, shape, components, layout, offset, builder)
 
-  @ti.func
-  def set(self, i, j, value):
-    self.current[i, j] = value
-
-  @ti.func
-  def get_prev(self, i, j):
-    return self.previous[i, j]
-
-  @ti.func
-  def get(self, i, j):
-    return self.current[i, j]
-
-  @ti.kernel
   def swap(self):
-    for i, j in self.current:
-      temp = self.previous[i, j]
-      self.previous[i, j] = self.current[i, j]
-      self.current[i, j] = temp
\ No newline at end of file
+    self.current, self.previous = self.previous, self.current
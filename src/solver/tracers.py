@@ -0,0 +1,150 @@
+import numpy as np
+import taichi as ti
+import taichi.math as tim
+from .temporal_value_field import TemporalValueField
+from .field_helpers import bilinear_interpolate_nearest, is_vector, new_field
+from .launch_counter import kernel
+
+# radians between neighbouring particles of an emitted disc
+GOLDEN_ANGLE = np.pi * (3 - np.sqrt(5))
+
+
+@ti.data_oriented
+class Tracers:
+  # Passive particles carried by the velocity, stored as separate x and y
+  # arrays of `capacity` entries with the first `count` of them alive.
+  # Positions are in field index units like the backtraces of `advect`,
+  # interior cell i spans [i - 0.5, i + 0.5]. Emitting appends in one
+  # kernel, killing compacts the survivors into the second buffer of each
+  # array and swaps, so every operation is one launch whatever the count
+  # and costs in proportion to the live particles. Particles past the
+  # capacity are dropped.
+  def __init__(self, n, capacity=2**20, builder=None):
+    self.n = n
+    self.capacity = capacity
+    self.x = TemporalValueField(capacity, ti.f32, builder=builder)
+    self.y = TemporalValueField(capacity, ti.f32, builder=builder)
+    self.count = new_field(ti.i32, (), builder=builder)
+
+  def __len__(self):
+    return int(self.count[None])
+
+  def emit(self, x: float, y: float, radius: float, count: int):
+    # `count` particles spread evenly over the disc of `radius` cells around (x, y)
+    _emit_disc(self.capacity, x, y, radius, count, self.x.current, self.y.current, self.count)
+
+  def emit_positions(self, positions: np.ndarray):
+    # one particle at every row (x, y) of `positions`
+    if len(positions):
+      _emit_positions(self.capacity, np.ascontiguousarray(positions, dtype=np.float32), self.x.current, self.y.current, self.count)
+
+  def kill(self, x0: float, y0: float, x1: float, y1: float):
+    # remove every particle inside the rectangle, the survivors keep no particular order
+    _kill_rectangle(x0, y0, x1, y1, self.x.current, self.y.current, self.x.previous, self.y.previous, self.count)
+    self.x.swap()
+    self.y.swap()
+
+  def clear(self):
+    self.count[None] = 0
+
+  def advect(self, dt: float, fluid):
+    # Move every particle with the current velocity of `fluid` over `dt`,
+    # sampling it at the midpoint of the move. Positions stay inside the
+    # interior like the backtraces of `advect` do.
+    if fluid.velocity is None:
+      velocity = (fluid.h_velocity.current, fluid.v_velocity.current)
+    else:
+      velocity = (fluid.velocity.current,)
+    _advect(self.n, dt, velocity, self.x.current, self.y.current, self.count)
+
+  def resize(self, n: int):
+    # keep every particle at the same place in the domain on an n x n grid
+    _rescale(n / self.n, self.x.current, self.y.current, self.count)
+    self.n = n
+
+  def positions(self) -> np.ndarray:
+    # (count, 2) array of the live positions, for measuring how they spread
+    count = len(self)
+    return np.stack([self.x.current.to_numpy()[:count], self.y.current.to_numpy()[:count]], axis=1)
+
+  def rasterize(self, pixels, value: float = 1.0):
+    # add `value` to the pixel under every particle, `pixels` stretched over the domain like `render` does
+    _rasterize(self.n, value, self.x.current, self.y.current, self.count, pixels)
+
+
+@ti.func
+def _velocity_at(velocity: ti.template(), x, y):
+  result = ti.Vector([0.0, 0.0])
+  if ti.static(is_vector(velocity[0])):
+    result = 1.0 * bilinear_interpolate_nearest(x, y, velocity[0])
+  else:
+    result = ti.Vector([bilinear_interpolate_nearest(x, y, velocity[0]), bilinear_interpolate_nearest(x, y, velocity[1])])
+  return result
+
+
+@ti.func
+def _append(capacity, x: ti.template(), y: ti.template(), count: ti.template(), px, py):
+  index = ti.atomic_add(count[None], 1)
+  if index < capacity:
+    x[index] = px
+    y[index] = py
+
+
+@kernel
+def _emit_disc(capacity: int, cx: float, cy: float, radius: float, emitted: int, x: ti.template(), y: ti.template(), count: ti.template()):
+  # a sunflower spiral at a random turn, square root spacing of the radius keeps the disc evenly covered
+  turn = 2 * tim.pi * ti.random()
+  for k in range(emitted):
+    r = radius * ti.sqrt((k + 0.5) / emitted)
+    angle = turn + GOLDEN_ANGLE * k
+    _append(capacity, x, y, count, cx + r * ti.cos(angle), cy + r * ti.sin(angle))
+  count[None] = ti.min(count[None], capacity)
+
+
+@kernel
+def _emit_positions(capacity: int, positions: ti.types.ndarray(), x: ti.template(), y: ti.template(), count: ti.template()):
+  for k in range(positions.shape[0]):
+    _append(capacity, x, y, count, positions[k, 0], positions[k, 1])
+  count[None] = ti.min(count[None], capacity)
+
+
+@kernel
+def _kill_rectangle(x0: float, y0: float, x1: float, y1: float, x: ti.template(), y: ti.template(), kept_x: ti.template(), kept_y: ti.template(), count: ti.template()):
+  alive = count[None]
+  count[None] = 0
+  for k in range(alive):
+    if not (x0 <= x[k] <= x1 and y0 <= y[k] <= y1):
+      index = ti.atomic_add(count[None], 1)
+      kept_x[index] = x[k]
+      kept_y[index] = y[k]
+
+
+@kernel
+def _advect(n: int, dt: float, velocity: ti.template(), x: ti.template(), y: ti.template(), count: ti.template()):
+  n_scale = dt * n
+  for k in range(count[None]):
+    start = ti.Vector([x[k], y[k]])
+    half = start + 0.5 * n_scale * _velocity_at(velocity, start[0], start[1])
+    half = tim.clamp(half, 0.5, n + 0.5)
+    end = start + n_scale * _velocity_at(velocity, half[0], half[1])
+    end = tim.clamp(end, 0.5, n + 0.5)
+    x[k] = end[0]
+    y[k] = end[1]
+
+
+@kernel
+def _rescale(scale: float, x: ti.template(), y: ti.template(), count: ti.template()):
+  for k in range(count[None]):
+    x[k] = (x[k] - 0.5) * scale + 0.5
+    y[k] = (y[k] - 0.5) * scale + 0.5
+
+
+@kernel
+def _rasterize(n: int, value: float, x: ti.template(), y: ti.template(), count: ti.template(), pixels: ti.template()):
+  width = pixels.shape[0]
+  height = pixels.shape[1]
+  for k in range(count[None]):
+    # the pixel `render` samples cell (x, y) at
+    i = ti.min(ti.max(int(ti.round(x[k] * width / n)), 0), width - 1)
+    j = ti.min(ti.max(int(ti.round(y[k] * height / n)), 0), height - 1)
+    pixels[i, j] += value
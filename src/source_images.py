@@ -0,0 +1,154 @@
+import queue
+import threading
+from collections import OrderedDict
+import numpy as np
+import imageio.v3 as imageio
+import taichi as ti
+from PIL import Image
+from image_loader import load_image, convert_to_greyscale
+
+# device memory the cached images of a `SourceImageCache` may hold
+DEFAULT_CACHE_BYTES = 256 * 2**20
+
+
+def prepare_image(image: np.ndarray, n: int) -> np.ndarray:
+  # Greyscale, resized to n x n and shaped the way `paint_image` always
+  # shaped pixels: read as signed bytes, a = |p / 128| * 2, a^2.5 + 1.
+  # Returned as float32 indexed [x, y - 1] of the field cells it lands on,
+  # so uploading it needs no further work on the device.
+  greyscale = convert_to_greyscale(image) if image.ndim == 3 else image
+  resized = np.asarray(Image.fromarray(np.asarray(greyscale, dtype=np.float32), mode="F").resize((n, n), Image.BILINEAR))
+  # read as signed bytes once resized, blending across the 127/128 wrap would leave dark seams
+  signed = np.clip(resized, 0, 255).astype(np.uint8).view(np.int8).astype(np.float32)
+  shaped = np.power(np.abs(signed / 128) * 2, 2.5) + 1
+  return np.ascontiguousarray(shaped[::-1].T, dtype=np.float32)
+
+
+def prepare_mask(image: np.ndarray, n: int, threshold: float = 0.5) -> np.ndarray:
+  # obstacles where the greyscale image is darker than `threshold` of white,
+  # n x n with mask[x, y] the interior cell (x + 1, y + 1) like `Obstacles.set_mask` takes
+  greyscale = convert_to_greyscale(image) if image.ndim == 3 else image
+  resized = np.asarray(Image.fromarray(np.asarray(greyscale, dtype=np.float32), mode="F").resize((n, n), Image.BILINEAR))
+  return np.ascontiguousarray(resized[::-1].T < threshold * 255)
+
+
+class SourceImageCache:
+  # Prepared images kept on the device, keyed by path. The least recently
+  # used ones are dropped once they hold more than `max_bytes`, so painting
+  # the same image again only copies it into the field.
+  def __init__(self, n: int, max_bytes: int = DEFAULT_CACHE_BYTES):
+    self.n = n
+    self.max_bytes = max_bytes
+    self.images = OrderedDict()
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, path: str):
+    image = self.images.get(path)
+    if image is not None:
+      self.hits += 1
+      self.images.move_to_end(path)
+      return image
+
+    self.misses += 1
+    image = upload(prepare_image(load_image(path), self.n))
+    self.images[path] = image
+    self.bytes += image_bytes(image)
+    while self.bytes > self.max_bytes and len(self.images) > 1:
+      _, evicted = self.images.popitem(last=False)
+      self.bytes -= image_bytes(evicted)
+    return image
+
+  def paint(self, path: str, field):
+    blit(self.get(path), field)
+
+
+class VideoSource:
+  # Decodes and prepares the frames of a video on a background thread,
+  # keeping up to `prefetch` of them ready. `paint` uploads the next one
+  # into a single reused device buffer and copies it into the field. With
+  # `loop` the video restarts at the end, otherwise `paint` returns False
+  # once every frame was shown. After `resize` frames already prepared for
+  # the old size are skipped.
+  def __init__(self, path: str, n: int, prefetch: int = 4, loop: bool = True):
+    self.path = path
+    self.n = n
+    self.loop = loop
+    self.frames_shown = 0
+    self.error = None
+    self.finished = False
+
+    self.frame = ti.ndarray(dtype=ti.f32, shape=(n, n))
+    self.queue = queue.Queue(maxsize=prefetch)
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.__run, daemon=True)
+    self.thread.start()
+
+  def paint(self, field) -> bool:
+    if self.finished:
+      return False
+
+    frame = self.queue.get()
+    if self.error is not None:
+      raise self.error
+    if frame is None:
+      self.finished = True
+      return False
+    if frame.shape != self.frame.shape:
+      return self.paint(field)
+
+    self.frame.from_numpy(frame)
+    blit(self.frame, field)
+    self.frames_shown += 1
+    return True
+
+  def resize(self, n: int):
+    self.n = n
+    self.frame = ti.ndarray(dtype=ti.f32, shape=(n, n))
+
+  def close(self):
+    self.stopped.set()
+    # unblock a decoder waiting for room in the queue
+    while self.thread.is_alive():
+      try:
+        self.queue.get_nowait()
+      except queue.Empty:
+        pass
+      self.thread.join(0.01)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *_):
+    self.close()
+
+  def __run(self):
+    try:
+      while not self.stopped.is_set():
+        for image in imageio.imiter(self.path):
+          if self.stopped.is_set():
+            return
+          self.queue.put(prepare_image(image, self.n))
+        if not self.loop:
+          break
+    except Exception as error:
+      self.error = error
+    self.queue.put(None)
+
+
+def upload(image: np.ndarray):
+  device_image = ti.ndarray(dtype=ti.f32, shape=image.shape)
+  device_image.from_numpy(image)
+  return device_image
+
+
+def image_bytes(image) -> int:
+  return image.shape[0] * image.shape[1] * 4
+
+
+@ti.kernel
+def blit(image: ti.types.ndarray(dtype=ti.f32, ndim=2), field: ti.template()):
+  # the cells `paint_image` always covered, x in [0, n) and y in [1, n]
+  for x, y in ti.ndrange(image.shape[0], image.shape[1]):
+    field[x, y + 1] = image[x, y]
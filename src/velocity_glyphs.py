@@ -0,0 +1,94 @@
+import taichi as ti
+import taichi.math as tim
+from solver.field_helpers import is_vector
+
+# glyphs along each side of the window when no stride is given
+DEFAULT_GLYPHS = 64
+
+
+@ti.data_oriented
+class VelocityGlyphs:
+  # One velocity line per `stride` x `stride` block of cells, so the
+  # vertex buffer holds 2 * (n / stride)^2 vertices whatever n is and
+  # filling it costs the same at any resolution. With `adaptive` every
+  # glyph samples the density at `samples` x `samples` points of its block,
+  # sits on the densest one and collapses to nothing where all are below
+  # `threshold`, so the lines follow the dye instead of a fixed lattice.
+  # Line colours run from blue at rest to red at `max_speed`.
+  def __init__(self, n, stride=None, adaptive=False, samples=4, threshold=0.01, max_speed=0.01):
+    if stride is None:
+      stride = max(1, n // DEFAULT_GLYPHS)
+
+    self.n = n
+    self.stride = stride
+    self.adaptive = adaptive
+    self.samples = min(samples, stride)
+    self.threshold = threshold
+    self.max_speed = max_speed
+
+    self.glyphs = (n + stride - 1) // stride
+    self.vertices = ti.Vector.field(3, dtype=ti.f32, shape=2 * self.glyphs * self.glyphs)
+    self.colors = ti.Vector.field(3, dtype=ti.f32, shape=2 * self.glyphs * self.glyphs)
+
+  def update(self, fluid):
+    if fluid.velocity is None:
+      velocity = (fluid.h_velocity.current, fluid.v_velocity.current)
+    else:
+      velocity = (fluid.velocity.current,)
+    _fill_glyphs(self.n, self.stride, self.glyphs, self.samples if self.adaptive else 0, self.threshold, self.max_speed, fluid.density.current, velocity, self.vertices, self.colors)
+
+  def draw(self, canvas, width=0.002):
+    canvas.lines(vertices=self.vertices, per_vertex_color=self.colors, width=width)
+
+
+@ti.func
+def _velocity_at(velocity: ti.template(), i, j):
+  result = ti.Vector([0.0, 0.0])
+  if ti.static(is_vector(velocity[0])):
+    result = 1.0 * velocity[0][i, j]
+  else:
+    result = ti.Vector([velocity[0][i, j], velocity[1][i, j]], dt=ti.f32)
+  return result
+
+
+@ti.kernel
+def _fill_glyphs(n: int, stride: int, glyphs: int, samples: int, threshold: float, max_speed: float, density: ti.template(), velocity: ti.template(), vertices: ti.template(), colors: ti.template()):
+  for gi, gj in ti.ndrange(glyphs, glyphs):
+    # interior cells of the block, clipped at the far edges
+    first_i = 1 + gi * stride
+    first_j = 1 + gj * stride
+    span_i = tim.min(stride, n + 1 - first_i)
+    span_j = tim.min(stride, n + 1 - first_j)
+
+    i = first_i + span_i // 2
+    j = first_j + span_j // 2
+    visible = True
+    if samples > 0:
+      # anchor on the densest of samples x samples evenly spread cells
+      densest = -1.0
+      for a, b in ti.ndrange(samples, samples):
+        si = first_i + (2 * a + 1) * span_i // (2 * samples)
+        sj = first_j + (2 * b + 1) * span_j // (2 * samples)
+        value = 1.0 * density[si, sj]
+        if value > densest:
+          densest = value
+          i = si
+          j = sj
+      visible = densest >= threshold
+
+    v = _velocity_at(velocity, i, j)
+    speed = v.norm()
+    start = ti.Vector([i / n, j / n, 0.0])
+    end = start
+    if visible and speed > 0:
+      # a glyph reaches at most across its own block
+      end = start + ti.Vector([v[0], v[1], 0.0]) / speed * (0.8 * stride / n)
+
+    heat = tim.clamp(speed / max_speed, 0.0, 1.0)
+    color = ti.Vector([heat, 0.0, 1.0 - heat])
+
+    glyph = gi * glyphs + gj
+    vertices[2 * glyph] = start
+    vertices[2 * glyph + 1] = end
+    colors[2 * glyph] = color
+    colors[2 * glyph + 1] = color
@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import subprocess
+
+# taken before taichi is imported, so `first-step` also counts importing and initializing it
+START = time.perf_counter()
+
+
+def build(args) -> dict:
+  # Compile every kernel of the config at each size into the offline cache.
+  # Cached kernels are keyed by the layout of the fields they touch, every
+  # size therefore compiles in a fresh process that allocates its fields
+  # the way a headless run does.
+  seconds = {}
+  for n in args.sizes or [None]:
+    start = time.perf_counter()
+    subprocess.run(child_command("compile", args, n, args.cache_directory), check=True, capture_output=True)
+    seconds[n] = time.perf_counter() - start
+    print(f"n={n}: compiled in {seconds[n]:.2f} s", file=sys.stderr)
+  return seconds
+
+
+def compile_kernels(args):
+  from headless import load_config, init_taichi, create_fluid
+
+  config = load_config(args.config, { "arch": args.arch, "n": args.n, "cache_directory": args.cache_directory })
+  init_taichi(config)
+  create_fluid(config).warm_up(config["time_step"])
+
+
+def child_command(command: str, args, n, cache_directory) -> list:
+  child = [sys.executable, os.path.abspath(__file__), command]
+  if args.config:
+    child.append(args.config)
+  if args.arch:
+    child += ["--arch", args.arch]
+  if n is not None:
+    child += ["--n", str(n)]
+  if cache_directory:
+    child += ["--cache-directory", cache_directory]
+  return child
+
+
+def first_step(args):
+  # runs in a fresh process, reports the time from start up to the end of the first step
+  import taichi as ti
+  from headless import load_config, init_taichi, create_fluid
+
+  config = load_config(args.config, { "arch": args.arch, "n": args.n, "cache_directory": args.cache_directory })
+  init_taichi(config)
+  initialized = time.perf_counter()
+
+  fluid = create_fluid(config)
+  n = fluid.n
+  fluid.add_density(n // 2, n // 10, 1, 1)
+  fluid.step(config["time_step"])
+  ti.sync()
+  stepped = time.perf_counter()
+
+  fluid.step(config["time_step"])
+  ti.sync()
+
+  print(json.dumps({
+    "init_seconds": initialized - START,
+    "first_step_seconds": stepped - initialized,
+    "startup_seconds": stepped - START,
+    "second_step_seconds": time.perf_counter() - stepped,
+  }))
+
+
+def measure(args) -> dict:
+  # Time to the first step of a fresh process with an empty cache and with
+  # the cache `build` filled. Both run in child processes so neither sees
+  # kernels compiled in this one.
+  def run_child(cache_directory):
+    output = subprocess.run(child_command("first-step", args, args.n, cache_directory), check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+  with tempfile.TemporaryDirectory() as cold_cache:
+    cold = run_child(cold_cache)
+  warm = run_child(args.cache_directory)
+
+  results = { "n": args.n, "cold": cold, "warm": warm, "speedup": cold["startup_seconds"] / warm["startup_seconds"] }
+  print(f"n={args.n}: cold {cold['startup_seconds']:.2f} s, warm {warm['startup_seconds']:.2f} s to the first step", file=sys.stderr)
+  return results
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Compile the solver kernels ahead of time and measure start up")
+  commands = parser.add_subparsers(dest="command", required=True)
+
+  build_parser = commands.add_parser("build", help="fill the offline cache for a headless config")
+  build_parser.add_argument("config", nargs="?", help="json file overriding the default headless config")
+  build_parser.add_argument("--arch", choices=["cpu", "gpu", "cuda", "vulkan", "metal"])
+  build_parser.add_argument("--sizes", type=int, nargs="+", help="grid sizes to compile for, the config's n when omitted")
+  build_parser.add_argument("--cache-directory", help="offline cache to fill, taichi's default when omitted")
+
+  measure_parser = commands.add_parser("measure", help="time a fresh process to its first step with a cold and a warm cache")
+  measure_parser.add_argument("config", nargs="?")
+  measure_parser.add_argument("--arch", choices=["cpu", "gpu", "cuda", "vulkan", "metal"])
+  measure_parser.add_argument("--n", type=int, default=256)
+  measure_parser.add_argument("--cache-directory", required=True, help="cache filled by `build`")
+  measure_parser.add_argument("--output", help="json file for the results, printed when omitted")
+
+  # run by `build` and `measure` in fresh processes
+  for command in ("compile", "first-step"):
+    child_parser = commands.add_parser(command)
+    child_parser.add_argument("config", nargs="?")
+    child_parser.add_argument("--arch", choices=["cpu", "gpu", "cuda", "vulkan", "metal"])
+    child_parser.add_argument("--n", type=int)
+    child_parser.add_argument("--cache-directory")
+
+  args = parser.parse_args(argv)
+  if args.command == "compile":
+    compile_kernels(args)
+    return 0
+  if args.command == "first-step":
+    first_step(args)
+    return 0
+
+  results = build(args) if args.command == "build" else measure(args)
+  if getattr(args, "output", None):
+    with open(args.output, "w") as file:
+      json.dump(results, file, indent=2)
+  else:
+    print(json.dumps(results, indent=2))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+import taichi as ti
+
+# the solver is imported as `solver`, like the scripts in src do
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+
+@pytest.fixture(scope="session", autouse=True)
+def taichi():
+  ti.init(arch=ti.cpu, random_seed=0, log_level=ti.ERROR)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from solver.distributed import DistributedFluidField
+from solver.fluid_field import FluidField
+from solver.smoothing import RedBlackSOR
+
+N = 64
+DT = 0.1
+
+
+def push(field):
+  # one cell pushed at 0.9 cells per unit time, a backtrace of 5.8 cells
+  # before viscosity 0.5 spreads it out
+  field.viscosity = 0.5
+  field.add_force(33, 32, 0, 9.0, 0)
+  field.step(DT)
+
+
+def single_process():
+  field = FluidField(N, velocity_layout="aos")
+  field.diffusion_smoother = RedBlackSOR()
+  field.pressure_smoother = RedBlackSOR()
+  push(field)
+  return field.density.current.to_numpy(), field.velocity.current.to_numpy()
+
+
+def test_fast_velocity_raises_past_the_halo():
+  with DistributedFluidField(N, workers=2, halo=4) as field:
+    with pytest.raises(RuntimeError, match="Advection backtraces"):
+      push(field)
+
+
+def test_fast_velocity_within_the_halo_matches_a_single_process():
+  density, velocity = single_process()
+  with DistributedFluidField(N, workers=2, halo=8) as field:
+    push(field)
+    result = field.gather()
+
+  np.testing.assert_array_equal(result["density"], density)
+  np.testing.assert_array_equal(result["velocity"], velocity)